@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from collections import deque
+import cv2
+import numpy as np
+
+from capture import FramePool
+from detection import BACKENDS, DetectionNet, available_backends, decode_batch, read_cfg, summarize_detections, draw_detections
+
+MODELS = {
+    "tiny": "yolo_utils/yolov4-tiny-mask.cfg",
+    "full": "yolo_utils/yolov4-mask.cfg",
+}
+
+
+def write_random_weights(config_path, weights_path, seed=0):
+    # darknet weights file with random convolutions and neutral batch normalization, so the outputs stay finite
+    sections = read_cfg(config_path)
+    channels = int(sections[0][1].get("channels", 3))
+    layer_channels = []
+    convolutions = []
+    for name, options in sections[1:]:
+        if name == "convolutional":
+            filters, size = int(options["filters"]), int(options["size"])
+            convolutions.append((filters, channels, size, int(options.get("batch_normalize", 0))))
+            channels = filters
+        elif name == "route":
+            layers = [int(layer) for layer in options["layers"].split(",")]
+            layers = [layer if layer >= 0 else len(layer_channels) + layer for layer in layers]
+            channels = sum(layer_channels[layer] for layer in layers) // int(options.get("groups", 1))
+        layer_channels.append(channels)
+    rng = np.random.default_rng(seed)
+    with open(weights_path, "wb") as weights_file:
+        np.array([0, 2, 5], dtype=np.int32).tofile(weights_file)
+        np.array([0], dtype=np.int64).tofile(weights_file)
+        for filters, channels, size, batch_normalize in convolutions:
+            (rng.standard_normal(filters) * 0.1).astype(np.float32).tofile(weights_file)
+            if batch_normalize:
+                np.ones(filters, dtype=np.float32).tofile(weights_file)  # scale
+                np.zeros(filters, dtype=np.float32).tofile(weights_file)  # mean
+                np.ones(filters, dtype=np.float32).tofile(weights_file)  # variance
+            fan_in = channels * size * size
+            (rng.standard_normal(filters * fan_in) * np.sqrt(1.0 / fan_in)).astype(np.float32).tofile(weights_file)
+
+
+def synthetic_frames(count, seed=0, size=(1280, 720)):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8) for _ in range(count)]
+
+
+def synthetic_detections(count, seed=0, size=(1280, 720)):
+    # fixed set of face boxes, so the post-processing cost does not depend on what the random weights detect
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(40, 160, (count, 2))
+    corners = rng.integers(0, np.array(size) - 160, (count, 2))
+    return rng.integers(0, 2, count), rng.uniform(0.5, 1.0, count).astype(np.float32), np.concatenate([corners, sizes], axis=1)
+
+
+def percentiles(times):
+    times = np.array(times) * 1000
+    return {"mean_ms": round(float(times.mean()), 3), "p50_ms": round(float(np.percentile(times, 50)), 3),
+            "p95_ms": round(float(np.percentile(times, 95)), 3), "p99_ms": round(float(np.percentile(times, 99)), 3)}
+
+
+def time_calls(function, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_model(config_path, weights_path, backend, input_sizes, camera_counts, runs, seed=0):
+    frames = synthetic_frames(max(camera_counts), seed)
+    start = time.perf_counter()
+    net = DetectionNet(config_path, weights_path, (input_sizes[0], input_sizes[0]))
+    net.set_backend(backend)
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    net.detect(frames[0], 0.5, 0.5)
+    warmup_time = time.perf_counter() - start
+    results = {"load_s": round(load_time, 4), "warmup_s": round(warmup_time, 4), "input_sizes": []}
+    for input_size in input_sizes:
+        size = (input_size, input_size)
+        net.model.setInputSize(*size)  # only used by the cv2.dnn_DetectionModel reference below
+        net.detect_batch(frames[:1], [0.5], [0.5], size)  # the first inference at a new size reallocates the network buffers
+        size_result = {"input_size": input_size, "latency": percentiles(time_calls(lambda: net.detect_batch(frames[:1], [0.5], [0.5], size), runs)), "cameras": []}
+        for cameras in camera_counts:
+            batch = frames[:cameras]
+            net.detect_batch(batch, [0.5] * cameras, [0.5] * cameras, size)
+            times = time_calls(lambda: net.detect_batch(batch, [0.5] * cameras, [0.5] * cameras, size), runs)
+            # the same frames one by one through cv2.dnn_DetectionModel, the path the batched NumPy decoding replaced
+            model_times = time_calls(lambda: [net.model.detect(frame, 0.5, 0.5) for frame in batch], runs)
+            size_result["cameras"].append({"cameras": cameras, "batch_latency": percentiles(times), "fps": round(cameras * len(times) / sum(times), 2),
+                                           "detection_model_latency": percentiles(model_times),
+                                           "detection_model_fps": round(cameras * len(model_times) / sum(model_times), 2),
+                                           "decode": benchmark_decoding(net, batch, size, runs)})
+        results["input_sizes"].append(size_result)
+        print(f"{os.path.basename(config_path)} {input_size}x{input_size}: p50 {size_result['latency']['p50_ms']:0.1f} ms, "
+              + ", ".join(f"{camera['cameras']} cameras {camera['fps']:0.1f} fps" for camera in size_result["cameras"]))
+    return results
+
+
+def benchmark_decoding(net, frames, input_size, runs):
+    # decoding and NMS alone, on the raw outputs of one forward pass, with a low threshold so the random weights give many boxes
+    net.net.setInput(net.make_blob(frames, input_size))
+    outputs = net.net.forward(net.output_names)
+    shapes = [frame.shape[:2] for frame in frames]
+    detections = decode_batch(outputs, shapes, [0.05] * len(frames), [0.5] * len(frames))
+    return {"boxes": sum(len(classes) for classes, confidences, boxes in detections),
+            "latency": percentiles(time_calls(lambda: decode_batch(outputs, shapes, [0.05] * len(frames), [0.5] * len(frames)), runs))}
+
+
+def benchmark_postprocessing(runs, faces=8, seed=0):
+    frame = synthetic_frames(1, seed)[0]
+    detections = synthetic_detections(faces, seed)
+    return {"faces": faces,
+            "summarize": percentiles(time_calls(lambda: summarize_detections(*detections), runs)),
+            "draw": percentiles(time_calls(lambda: draw_detections(frame.copy(), summarize_detections(*detections)), runs))}
+
+
+def benchmark_frame_lifecycle(frame_count=60, seed=0):
+    # reads, keeps and annotates the frames of a synthetic video the way the cameras used to (new arrays everywhere)
+    # and with the frame pool and the overlay buffer, every full frame array that is not a reused buffer counts as an allocation
+    frames = synthetic_frames(4, seed)
+    result = summarize_detections(*synthetic_detections(8, seed))
+    report = {"frames": frame_count}
+    with tempfile.TemporaryDirectory() as video_dir:
+        video_path = os.path.join(video_dir, "frames.avi")
+        writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (1280, 720))
+        for i in range(frame_count):
+            writer.write(frames[i % len(frames)])
+        writer.release()
+        for name, pooled in [("allocating", False), ("pooled", True)]:
+            cam = cv2.VideoCapture(video_path)
+            pool = FramePool() if pooled else None
+            overlay = None
+            held = deque(maxlen=3)  # frames still referenced elsewhere: the newest, the one in the detector, the displayed one
+            allocations = 0
+            times = []
+            while True:
+                start = time.perf_counter()
+                buffer = pool.acquire() if pooled else None
+                ret, frame = cam.read(buffer)
+                if not ret:
+                    break
+                if pooled:
+                    pool.returned(buffer, frame)
+                    if overlay is None:
+                        overlay = np.empty_like(frame)
+                        allocations += 1
+                    np.copyto(overlay, frame)
+                    annotated = draw_detections(overlay, result)
+                    outputs = [annotated, cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB, dst=overlay)]
+                else:
+                    last_image = frame.copy()
+                    annotated = draw_detections(frame.copy(), result)
+                    outputs = [frame, last_image, annotated, cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)]
+                held.append(frame)
+                times.append(time.perf_counter() - start)
+                allocations += sum(1 for output in outputs if output is not overlay)
+            if pooled:
+                allocations += pool.allocations  # reads that did not go into a free buffer
+            cam.release()
+            report[name] = {"frame_allocations": allocations, "allocations_per_frame": round(allocations / max(1, len(times)), 2),
+                            "frame_mb_per_frame": round(allocations / max(1, len(times)) * 1280 * 720 * 3 / 1e6, 2), "latency": percentiles(times)}
+    return report
+
+
+def run(models, backend, input_sizes, camera_counts, runs, seed=0):
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": seed, "runs": runs, "backend": backend, "frame_size": [1280, 720],
+              "environment": {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__,
+                              "machine": platform.machine(), "cpu_count": os.cpu_count(), "opencv_threads": cv2.getNumThreads()},
+              "models": {}, "postprocessing": benchmark_postprocessing(runs * 10, seed=seed),
+              "frame_lifecycle": benchmark_frame_lifecycle(seed=seed)}
+    with tempfile.TemporaryDirectory() as weights_dir:
+        for model in models:
+            weights_path = os.path.join(weights_dir, model + ".weights")
+            write_random_weights(MODELS[model], weights_path, seed)
+            report["models"][model] = benchmark_model(MODELS[model], weights_path, backend, input_sizes, camera_counts, runs, seed)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the detection with random weights and synthetic 1280x720 frames, no weights download needed")
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS), help="network configurations to benchmark")
+    parser.add_argument("--backend", default="opencv", choices=list(BACKENDS), help="DNN backend/target used for the detection")
+    parser.add_argument("--input-sizes", nargs="+", type=int, default=[320, 416, 640], help="network input sizes (multiples of 32)")
+    parser.add_argument("--cameras", nargs="+", type=int, default=[1, 4, 8], help="number of camera frames detected in a single batch")
+    parser.add_argument("--runs", type=int, default=20, help="timed inferences per measurement")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random weights and frames")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to, - writes them to the standard output")
+    args = parser.parse_args()
+    if args.backend not in available_backends():
+        parser.error(f"the {args.backend} backend is not available in this OpenCV build")
+    report = run(args.models, args.backend, args.input_sizes, args.cameras, args.runs, args.seed)
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,279 @@
+import os
+import math
+import time
+import cv2
+import numpy as np
+from datetime import datetime
+
+import settings
+from detection import summarize_detections, scale_boxes
+from capture import FrameGrabber, FramePool, ScaledFrame
+from motion_gate import MotionGate
+from tracking import BoxTracker
+from metrics import CameraMetrics
+from snapshot_writer import get_snapshot_writer
+from input_size import AdaptiveInputSize
+from regions import parse_regions, parse_tiles, tile_layout
+
+
+def read_camera_list(cam_list_filename):
+    camera_dict = {}
+    for cam_line in [cam_line.strip() for cam_line in open(cam_list_filename)]:
+        if not cam_line:
+            continue
+        if cam_line.split(" ")[1].isdigit():
+            camera_dict[cam_line.split(" ")[0]] = int(cam_line.split(" ")[1])
+        else:
+            camera_dict[cam_line.split(" ")[0]] = cam_line.split(" ")[1]
+    return camera_dict
+
+
+def read_camera_settings(filename):
+    # optional per-camera settings kept next to the camera list, one "name value" line per camera
+    camera_settings = {}
+    if os.path.isfile(filename):
+        for line in open(filename):
+            fields = line.split(maxsplit=1)
+            if len(fields) == 2:
+                camera_settings[fields[0]] = fields[1].strip()
+    return camera_settings
+
+
+def parse_input_size(value):
+    return "auto" if str(value) == "auto" else int(value)
+
+
+def needs_photo(prev_status, status):
+    # a photo is taken when the status of a camera switches to "Warning" or "Danger"
+    if prev_status == "Safe" or prev_status == "Not Connected":
+        return status == "Warning" or status == "Danger"
+    elif prev_status == "Warning" and status == "Danger":
+        return True
+    elif prev_status == "Danger" and status == "Warning":
+        return True
+    return False
+
+
+class CameraStream:
+    # the part of a camera that does not depend on Qt: video source, detection state and automatic photos
+    def __init__(self, camName, camID, confThreshold=0.5, nmsThreshold=0.5, input_size=None):
+        self.camName = camName
+        self.camID = camID
+        self.confThreshold = confThreshold
+        self.nmsThreshold = nmsThreshold
+        if input_size is None:
+            input_size = read_camera_settings(settings.camera_input_size_path).get(camName, settings.input_size)
+        self.input_size = parse_input_size(input_size)  # network input size of this camera, "auto" adapts it to the faces it sees
+        self.adaptive_size = AdaptiveInputSize(settings.min_face_height) if self.input_size == "auto" else None
+        self.max_input_size = None  # lowered by the overload controller
+        self.regions = parse_regions(read_camera_settings(settings.camera_roi_path).get(camName, ""))  # only these parts of the frame are detected
+        self.tiles = parse_tiles(read_camera_settings(settings.camera_tiles_path).get(camName, settings.tiles))  # (columns, rows) of a camera without regions
+        self.pacing = read_camera_settings(settings.camera_pacing_path).get(camName, settings.pacing)  # realtime, every_frame or fast
+        self.source_fps = 0  # CAP_PROP_FPS of the open stream
+        self.on_frame = None  # called from the grabber thread when a frame is waiting, wakes up the loop driving the cameras
+        self.status = "Not Connected"
+        self.prev_status = "Not Connected"
+        self.last_image = None
+        self.last_detections = None
+        self.last_result = None
+        self.motion_gate = MotionGate(settings.motion_threshold, settings.motion_refresh)
+        self.tracker = BoxTracker(settings.detect_interval, settings.tracker_min_confidence)
+        self.metrics = CameraMetrics()
+        self.cam = None  # opened by connect_stream, away from the thread running the cameras
+        self.grabber = None
+        self.frame_pool = FramePool(settings.frame_buffers)  # the frames are read into these buffers instead of new arrays
+        self.detection_pool = FramePool(settings.frame_buffers)  # ... and scaled down to the detection resolution into these
+        self.overlay_buffer = None
+        self.submit_time = None
+        self.detect_latency = 0
+        self.max_fps = 0  # lowered by the overload controller, 0 takes every new frame
+        self.last_frame_time = 0
+
+    def start_grabber(self):
+        self.source_fps = self.cam.get(cv2.CAP_PROP_FPS)
+        # a live source delivers its frames at its own fps, only a file has to be paced
+        fps = self.source_fps if os.path.isfile(str(self.camID)) else 0
+        self.grabber = FrameGrabber(self.cam, fps, self.metrics, self.frame_pool, self.detection_pool,
+                                    self.detection_resolution() if settings.scale_frames else None, self.pacing, self.on_frame)
+        self.grabber.start()
+
+    def stop_camera(self):
+        if self.grabber is not None:
+            self.grabber.on_frame = None  # the loop driving the cameras may be going away
+            # a stalled stream is left to its thread instead of waiting for a read that may never return
+            self.grabber.stop(0 if self.grabber.stalled(settings.read_timeout) else 1.0)
+            self.metrics.dropped_frames += self.grabber.dropped_frames
+            self.grabber = None
+        elif self.cam is not None:
+            self.cam.release()
+        self.cam = None
+
+    def write_connect_log(self, event):
+        with open(settings.connect_log_path, "a") as connect_log:
+            connect_log.write(datetime.now().strftime("%d/%m/%Y - %H:%M:%S ->\t") + self.camName + " (ID: " + str(self.camID) + ") " + event + " the system.\n\n")
+
+    def connect_stream(self):
+        # blocks until the source answers or gives up, so it runs on a ReconnectScheduler thread
+        try:
+            if isinstance(self.camID, str):
+                # network streams (and files) are opened by FFmpeg, which gives up on a silent server after these timeouts
+                cam = cv2.VideoCapture(self.camID, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(settings.open_timeout * 1000),
+                                                                 cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(settings.read_timeout * 1000)])
+            else:
+                cam = cv2.VideoCapture(self.camID)
+            if cam.isOpened() and cam.get(cv2.CAP_PROP_FPS) != 0:
+                if not isinstance(self.camID, str):
+                    # only the cameras of the system deliver the resolution they are asked for, FFmpeg decodes files and streams at their own
+                    width, height = self.capture_resolution()
+                    cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                    cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+                # the stream only counts as open once it delivered a frame
+                if cam.grab():
+                    return cam
+            cam.release()
+        except cv2.error:
+            pass
+        return None
+
+    def open_stream(self, cam):
+        self.cam = cam
+        self.submit_time = None  # a frame of the previous stream may have been discarded before its detection
+        self.write_connect_log("connected to")
+        self.metrics.connects += 1
+        self.start_grabber()
+        self.motion_gate.reset()
+        self.tracker.reset()
+        if self.adaptive_size is not None:
+            self.adaptive_size.reset()
+        self.status = "Safe"
+
+    def close_stream(self):
+        self.write_connect_log("disconnected from")
+        self.metrics.disconnects += 1
+        self.status = "Not Connected"
+        self.stop_camera()
+
+    def frame_age(self):
+        return round(time.monotonic() - self.grabber.last_frame_time, 3) if self.grabber is not None else 0
+
+    def dropped_frames(self):
+        return self.metrics.dropped_frames + (self.grabber.dropped_frames if self.grabber is not None else 0)
+
+    def next_frame(self):
+        # returns the newest frame and the detections describing it, which are None when the frame needs the detector
+        if self.grabber.failed:
+            raise IOError("no frame received from " + self.camName)
+        if self.grabber.stalled(settings.read_timeout):
+            self.metrics.stalls += 1
+            raise IOError(f"no frame received from {self.camName} for {settings.read_timeout} s")
+        if self.max_fps and time.monotonic() - self.last_frame_time < 1 / self.max_fps:
+            return None, None
+        if self.pacing != "realtime" and self.submit_time is not None:
+            # every frame is detected, the next one waits in the grabber until the detection of this one is done
+            return None, None
+        image = self.grabber.latest()
+        if image is None:
+            return None, None
+        self.last_frame_time = time.monotonic()
+        with self.metrics.time("motion_gate"):
+            moved = self.motion_gate.changed(image)
+        if not moved and self.last_detections is not None:
+            # nothing moved since the last detection, so its result still describes the scene
+            return image, self.last_detections
+        if self.tracker.needs_detection():
+            self.submit_time = time.perf_counter()
+            return image, None
+        with self.metrics.time("track"):
+            return image, self.tracker.track(image)
+
+    def frame_waiting(self):
+        return self.grabber is not None and self.grabber.has_frame()
+
+    def wake_delay(self, watchdog=0.5):
+        # time (s) until next_frame has to run again without a new frame: the end of the fps limit, else a stall check
+        if self.max_fps:
+            remaining = 1 / self.max_fps - (time.monotonic() - self.last_frame_time)
+            if remaining > 0:
+                return min(remaining, watchdog)
+        return watchdog
+
+    def detection_input_size(self):
+        size = self.adaptive_size.next_size() if self.adaptive_size is not None else self.input_size
+        if self.max_input_size:
+            size = min(size, self.max_input_size)
+        return size, size
+
+    def detection_resolution(self):
+        # smallest frame size that keeps every pixel the detector uses, None keeps the decoded size
+        if self.regions:
+            return None  # the regions are given in pixels of the decoded frame
+        size = self.adaptive_size.sizes[-1] if self.adaptive_size is not None else self.input_size
+        columns, rows = self.tiles or (1, 1)
+        overlap = settings.tile_overlap if self.tiles else 0
+        return math.ceil(size * (columns - (columns - 1) * overlap)), math.ceil(size * (rows - (rows - 1) * overlap))
+
+    def capture_resolution(self):
+        # resolution asked from a camera of the system: enough for the display and the photos, more when the tiles need it
+        width, height = settings.capture_size
+        detection = self.detection_resolution() or (0, 0)
+        return max(width, detection[0]), max(height, detection[1])
+
+    def detection_regions(self, image):
+        # the regions of interest, else the tiles of this resolution, else None for the whole frame
+        if self.regions:
+            return self.regions
+        if self.tiles:
+            return tile_layout(image.shape[1], image.shape[0], *self.tiles, settings.tile_overlap)
+        return None
+
+    def detection_done(self, image, detections):
+        if self.submit_time is not None:
+            # time between the submission of the frame and its detections, waiting for the batch included
+            self.detect_latency = time.perf_counter() - self.submit_time
+            self.metrics.stage("detect").observe(self.detect_latency)
+            self.submit_time = None
+        if self.adaptive_size is not None:
+            # the faces of a tiled frame are seen at the height of a tile
+            regions = self.detection_regions(image)
+            height = regions[0].rect[3] if regions and not regions[0].keep_density else image.shape[0]
+            self.adaptive_size.update(detections[2], height)
+        if self.tracker.detect_interval > 1:
+            with self.metrics.time("track"):
+                detections = self.tracker.update(image, *detections)
+        return self.show_detections(image, detections)
+
+    def show_detections(self, image, detections):
+        return self.update_detections(image, detections)
+
+    def update_detections(self, image, detections):
+        # a frame still in the inference queue when the camera disconnected is ignored
+        if self.status == "Not Connected":
+            return None
+        # the frame is a pool buffer only read from now on, annotations go to the overlay and photos get a copy
+        full_image = image.full_frame if isinstance(image, ScaledFrame) else image
+        self.last_image = full_image
+        self.last_detections = detections  # in pixels of the detected frame, which the motion gate and the tracker keep working on
+        with self.metrics.time("postprocess"):
+            if full_image is not image:
+                # the result describes the decoded frame shown and photographed
+                detections = detections[0], detections[1], scale_boxes(detections[2], image.shape, full_image.shape)
+            self.last_result = summarize_detections(*detections)
+        self.status = self.last_result.status
+        if needs_photo(self.prev_status, self.status):
+            with self.metrics.time("photo"):
+                self.take_photo()
+        self.prev_status = self.status
+        self.metrics.frame_done()
+        return self.last_result
+
+    def overlay(self, image):
+        # the frame copied into a buffer reused from frame to frame, for the annotations of the displayed camera
+        if self.overlay_buffer is None or self.overlay_buffer.shape != image.shape:
+            self.overlay_buffer = np.empty_like(image)
+        np.copyto(self.overlay_buffer, image)
+        return self.overlay_buffer
+
+    def take_photo(self):
+        today = datetime.now().strftime("%d.%m.%Y")
+        image_name = self.camName + "_" + datetime.now().strftime("%d.%m.%Y_%H.%M.%S")
+        get_snapshot_writer().write(os.path.join(settings.photo_path, today, self.status), image_name, self.last_image.copy())
@@ -0,0 +1,162 @@
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class FramePool:
+    # preallocated frame buffers of one camera, a buffer is read into again once nothing outside the pool references it
+    def __init__(self, size=6):
+        self.size = size  # frames a camera can hold at once: the newest, the ones in the detector, the displayed one
+        self.buffers = []
+        self.allocations = 0  # frames read into a new array because no buffer was free or the frame size changed
+
+    def acquire(self):
+        # a free buffer or None, the pool and getrefcount's argument are the only references of a free one (views count as references)
+        for i in range(len(self.buffers)):
+            if sys.getrefcount(self.buffers[i]) <= 2:
+                return self.buffers[i]
+        return None
+
+    def returned(self, buffer, frame):
+        # records the array the read returned, which is the buffer itself unless the capture had to allocate
+        if frame is buffer:
+            return
+        self.allocations += 1
+        if buffer is not None:
+            # a buffer of the previous resolution
+            self.buffers[next(i for i in range(len(self.buffers)) if self.buffers[i] is buffer)] = frame
+        elif len(self.buffers) < self.size:
+            self.buffers.append(frame)
+
+
+class ScaledFrame(np.ndarray):
+    # a frame scaled down for the detector, full_frame is the decoded frame it was made from, for the display and the photos
+    full_frame = None
+
+
+def scaled_size(frame_shape, min_size, max_scale=0.75):
+    # the smallest size with the aspect ratio of the frame that is at least min_size, None when it would not save enough to pay for the resize
+    height, width = frame_shape[:2]
+    scale = max(min_size[0] / width, min_size[1] / height)
+    if scale > max_scale:
+        return None
+    return round(width * scale), round(height * scale)
+
+
+class FrameGrabber(threading.Thread):
+    # reads a video source continuously on its own thread and keeps only the newest frame
+    def __init__(self, cam, fps=0, metrics=None, pool=None, detection_pool=None, detection_size=None, pacing="realtime", on_frame=None):
+        super().__init__(daemon=True)
+        self.cam = cam
+        self.metrics = metrics
+        self.pool = pool
+        self.detection_pool = detection_pool if detection_pool is not None else FramePool()
+        self.detection_size = detection_size  # (width, height) the detector needs, larger frames are scaled down to it here
+        self.pacing = pacing  # "realtime" drops the frames the camera did not take in time, "every_frame" and "fast" wait for it
+        # video files are paced at their own fps unless they are read as fast as possible, live sources are read as they come
+        self.frame_interval = 1 / fps if fps > 0 and pacing != "fast" else 0
+        self.on_frame = on_frame  # called on this thread when a frame arrives and none was waiting, and when the source fails
+        self.lock = threading.Lock()
+        self.taken = threading.Condition(self.lock)  # notified when the waiting frame is taken
+        self.frame = None
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.failed = False
+        self.running = True
+        self.finished = False
+        self.release_on_exit = False
+        self.last_frame_time = time.monotonic()
+
+    def run(self):
+        next_read = time.monotonic()
+        while self.running:
+            start = time.perf_counter()
+            buffer = self.pool.acquire() if self.pool is not None else None
+            ret, frame = self.cam.read(buffer)
+            if ret and self.pool is not None:
+                self.pool.returned(buffer, frame)
+            if self.metrics is not None:
+                self.metrics.stage("read").observe(time.perf_counter() - start)
+            if not ret:
+                self.failed = True
+                if self.on_frame is not None:
+                    self.on_frame()
+                break
+            size = scaled_size(frame.shape, self.detection_size) if self.detection_size is not None else None
+            if size is not None:
+                start = time.perf_counter()
+                buffer = self.detection_pool.acquire()
+                scaled = cv2.resize(frame, size, dst=buffer)
+                self.detection_pool.returned(buffer, scaled)
+                # a new view of the buffer per frame, the full frame stays referenced as long as the scaled one
+                scaled = scaled.view(ScaledFrame)
+                scaled.full_frame, frame = frame, scaled
+                if self.metrics is not None:
+                    self.metrics.stage("scale").observe(time.perf_counter() - start)
+            with self.lock:
+                if self.pacing != "realtime":
+                    # no frame is dropped, the source waits for the camera to take the previous one
+                    while self.frame is not None and self.running:
+                        self.taken.wait(0.1)
+                waiting = self.frame is not None
+                if waiting:
+                    self.dropped_frames += 1
+                self.frame = frame
+                self.frame_count += 1
+                self.last_frame_time = time.monotonic()
+            if not waiting and self.on_frame is not None:
+                self.on_frame()
+            if self.frame_interval:
+                next_read = self.pace(next_read)
+        with self.lock:
+            self.finished = True
+            release = self.release_on_exit
+        if release:
+            self.cam.release()
+
+    def latest(self):
+        # hands out the newest frame once, None means nothing new arrived since the last call
+        with self.lock:
+            frame, self.frame = self.frame, None
+            self.taken.notify()
+        return frame
+
+    def has_frame(self):
+        return self.frame is not None
+
+    def pace(self, next_read):
+        # waits for the time of the next frame of the file, returns the time of the one after
+        next_read += self.frame_interval
+        late = time.monotonic() - next_read
+        if late > self.frame_interval and self.pacing == "realtime":
+            # the decoding fell behind the clock, the frames are skipped without decoding them to catch up
+            skipped = int(late / self.frame_interval)
+            for _ in range(skipped):
+                if not self.cam.grab():
+                    break
+            with self.lock:
+                self.dropped_frames += skipped
+            next_read += skipped * self.frame_interval
+        elif late > 0 and self.pacing != "realtime":
+            # every frame is shown, a slow detection delays the next ones instead of making them burst to catch up
+            next_read = time.monotonic()
+        time.sleep(max(0, next_read - time.monotonic()))
+        return next_read
+
+    def stalled(self, timeout):
+        # True when no frame arrived for `timeout` seconds, 0 never considers the source stalled,
+        # nor does a frame still waiting to be taken: with every_frame and fast pacing the source waits for it
+        return self.frame is None and 0 < timeout < time.monotonic() - self.last_frame_time
+
+    def stop(self, timeout=1.0):
+        # releases the source, a read hanging on a dead stream cannot be interrupted so the thread releases it once the read returns
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
+        with self.lock:
+            if not self.finished:
+                self.release_on_exit = True
+                return
+        self.cam.release()
@@ -0,0 +1,128 @@
+import sys
+import time
+import numpy as np
+
+from detection import summarize_detections
+from metrics import RollingHistogram
+
+
+class CascadeInference:
+    # runs every frame through a fast stage and only the uncertain ones through the accurate stage
+    def __init__(self, fast, accurate, fast_model, band=0.15):
+        self.fast = fast
+        self.accurate = accurate
+        self.fast_model = fast_model  # (config, weights) of the fast stage, escalating to the same model would change nothing
+        self.escalate = True
+        self.band = band  # detections within this distance of the confidence threshold are uncertain
+        self.frames = {}  # frames inside one of the stages, with the arguments they were submitted with
+        self.waiting = {}
+        self.statuses = {}  # last status returned per key, a frame that would change it is confirmed by the accurate stage
+        self.frame_count = 0
+        self.escalations = {"band": 0, "status": 0}
+        self.fast_seconds = RollingHistogram()
+        self.accurate_seconds = RollingHistogram()
+        self.fast_forward = 0.0  # time the networks of the stages spent on the frames of the cascade, without the batch and queue waits
+        self.accurate_forward = 0.0
+        self.accurate_frames = 0
+        self.accurate_frame_seconds = 0.0  # cost of a frame in the accurate model, measured at the warm-up
+
+    def submit(self, key, img, confThreshold, nmsThreshold, input_size=None, regions=None):
+        if key in self.frames:
+            # a frame can be escalated after its fast detection, so a newer frame waits for it
+            self.waiting[key] = (img, confThreshold, nmsThreshold, input_size, regions)
+            return
+        self.frames[key] = (img, confThreshold, nmsThreshold, input_size, regions, time.perf_counter(), False)
+        # the fast stage also returns the detections just under the threshold, they make a frame uncertain
+        self.fast.submit(key, img, max(0.01, confThreshold - self.band), nmsThreshold, input_size, regions)
+
+    def discard(self, key):
+        self.fast.discard(key)
+        self.accurate.discard(key)
+        self.frames.pop(key, None)
+        self.waiting.pop(key, None)
+        self.statuses.pop(key, None)
+
+    def clear(self):
+        self.fast.clear()
+        self.accurate.clear()
+        self.frames = {}
+        self.waiting = {}
+        self.statuses = {}
+
+    def close(self):
+        if self.frame_count:
+            print(f"Cascade: {self.escalated()} of {self.frame_count} frames escalated ({self.escalation_rate():.0%}), about {self.saved_seconds():.1f} s saved", file=sys.stderr)
+        self.fast.close()
+        self.accurate.close()
+
+    def queue_depth(self):
+        return self.fast.queue_depth() + self.accurate.queue_depth()
+
+    def forward_time(self):
+        return self.fast_forward + self.accurate_forward
+
+    def set_model(self, config_path, weights_path):
+        # the overload controller replaces the accurate model, the fast one stays
+        self.accurate.set_model(config_path, weights_path)
+        self.escalate = (config_path, weights_path) != self.fast_model
+
+    def escalated(self):
+        return sum(self.escalations.values())
+
+    def escalation_rate(self):
+        return self.escalated() / self.frame_count if self.frame_count else 0.0
+
+    def saved_seconds(self):
+        # network time saved compared with running the accurate model on every frame, the escalated frames give its cost once there are some
+        frame_seconds = self.accurate_forward / self.accurate_frames if self.accurate_frames else self.accurate_frame_seconds
+        return self.frame_count * frame_seconds - self.fast_forward - self.accurate_forward
+
+    def check(self, key, confThreshold, detections):
+        # returns the detections of the fast stage above the threshold and why the frame needs the accurate stage, None when it does not
+        classes, confidences, boxes = [np.asarray(value) for value in detections]
+        confidences = confidences.reshape(-1)
+        keep = confidences >= confThreshold
+        detections = classes.reshape(-1)[keep], confidences[keep], boxes.reshape(-1, 4)[keep]
+        if np.any(np.abs(confidences - confThreshold) < self.band):
+            return detections, "band"
+        status = summarize_detections(*detections).status
+        if self.statuses.get(key, status) != status:
+            return detections, "status"
+        return detections, None
+
+    def poll(self, expected=None):
+        escalated = sum(frame[6] for frame in self.frames.values())
+        results = []
+        start = self.fast.forward_time()
+        fast_results = self.fast.poll(None if expected is None else max(1, expected - escalated))
+        self.fast_forward += self.fast.forward_time() - start
+        for key, img, detections in fast_results:
+            if key not in self.frames:
+                continue
+            img, confThreshold, nmsThreshold, input_size, regions, submit_time, _ = self.frames[key]
+            now = time.perf_counter()
+            self.fast_seconds.observe(now - submit_time)
+            self.frame_count += 1
+            detections, reason = self.check(key, confThreshold, detections)
+            if reason is not None and self.escalate:
+                self.escalations[reason] += 1
+                self.frames[key] = (img, confThreshold, nmsThreshold, input_size, regions, now, True)
+                self.accurate.submit(key, img, confThreshold, nmsThreshold, input_size, regions)
+                continue
+            results.append((key, img, detections))
+        escalated = sum(frame[6] for frame in self.frames.values())
+        if escalated:
+            start = self.accurate.forward_time()
+            accurate_results = self.accurate.poll(escalated)
+            self.accurate_forward += self.accurate.forward_time() - start
+            for key, img, detections in accurate_results:
+                if key in self.frames:
+                    self.accurate_seconds.observe(time.perf_counter() - self.frames[key][5])
+                    self.accurate_frames += 1
+                    results.append((key, img, detections))
+        for key, img, detections in results:
+            del self.frames[key]
+            self.statuses[key] = summarize_detections(*detections).status
+            if key in self.waiting:
+                self.submit(key, *self.waiting.pop(key))
+        return results
@@ -0,0 +1,331 @@
+import sys
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+
+LABELS = ["Without Mask", "Mask"]
+COLORS = [[0, 0, 255], [0, 255, 0]]
+# LABELS = ["Mask", "Without Mask"]
+# COLORS = [[0, 255, 0], [0, 0, 255]]
+YoloLayer = namedtuple("YoloLayer", ["anchors", "scale_x_y", "classes"])
+DetectionResult = namedtuple("DetectionResult", ["classes", "confidences", "boxes", "mask_count", "nomask_count", "status"])
+DEFAULT_INPUT_SIZE = (640, 640)
+BACKENDS = {
+    "cuda": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA),
+    "cuda_fp16": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16),
+    "openvino": (cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE, cv2.dnn.DNN_TARGET_CPU),
+    "opencl": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL),
+    "opencl_fp16": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL_FP16),
+    "vulkan": (cv2.dnn.DNN_BACKEND_VKCOM, cv2.dnn.DNN_TARGET_VULKAN),
+    "opencv": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU),
+}
+
+
+class DetectionNet:
+    def __init__(self, config_path, weights_path, input_size=(640, 640)):
+        self.setup(config_path, weights_path, input_size, "opencv")
+        if self.yolo_layers is not None:
+            self.net = cv2.dnn.readNetFromONNX(weights_path)
+            return
+        self.net = cv2.dnn.readNet(config_path, weights_path)
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+        # the detection model shares the underlying network, so single frames and batches use the same weights
+        self.model = cv2.dnn_DetectionModel(self.net)
+        self.model.setInputSize(*input_size)
+        self.model.setInputScale(1.0 / 255)
+        self.model.setInputSwapRB(True)
+
+    def setup(self, config_path, weights_path, input_size, backend):
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.input_size = input_size
+        self.blobs = {}
+        self.backend = backend
+        self.model = None
+        self.yolo_layers = None
+        if weights_path.endswith(".onnx"):
+            # an export_onnx.py model stops before the [yolo] layers, they are decoded with the anchors of its cfg
+            self.yolo_layers = read_yolo_layers(config_path)
+            self.output_names = [f"yolo_{i}" for i in range(len(self.yolo_layers))]
+
+    def set_backend(self, name):
+        backend, target = BACKENDS[name]
+        self.net.setPreferableBackend(backend)
+        self.net.setPreferableTarget(target)
+        self.backend = name
+
+    def detect(self, img, confThreshold, nmsThreshold):
+        return self.detect_batch([img], [confThreshold], [nmsThreshold])[0]
+
+    def make_blob(self, images, input_size):
+        if not hasattr(cv2.dnn, "blobFromImagesWithParams"):
+            return cv2.dnn.blobFromImages(images, 1.0 / 255, input_size, swapRB=True, crop=False)
+        # the blob of every batch shape is allocated once and refilled, so tiles and steady batches do not allocate per frame
+        key = (len(images), input_size)
+        if key not in self.blobs:
+            self.blobs[key] = np.zeros((len(images), 3, input_size[1], input_size[0]), dtype=np.float32)
+        return cv2.dnn.blobFromImagesWithParams(images, self.blobs[key], self.blob_params(input_size))
+
+    def blob_params(self, input_size):
+        params = cv2.dnn.Image2BlobParams()
+        params.scalefactor = (1.0 / 255, 1.0 / 255, 1.0 / 255, 1.0 / 255)
+        params.size = input_size
+        params.swapRB = True
+        params.ddepth = cv2.CV_32F
+        return params
+
+    def forward(self, blob):
+        self.net.setInput(blob)
+        return self.net.forward(self.output_names)
+
+    def detect_batch(self, images, confThresholds, nmsThresholds, input_size=None):
+        input_size = tuple(input_size or self.input_size)
+        outputs = self.forward(self.make_blob(images, input_size))
+        if self.yolo_layers is not None:
+            outputs = decode_yolo_outputs(outputs, self.yolo_layers, input_size)
+        return decode_batch(outputs, [img.shape[:2] for img in images], confThresholds, nmsThresholds)
+
+
+class OnnxRuntimeNet(DetectionNet):
+    # an ONNX export run by onnxruntime instead of OpenCV, which also runs the int8 quantized exports
+    size_warned = False
+
+    def __init__(self, config_path, weights_path, input_size=(640, 640)):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(weights_path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        # unlike OpenCV, onnxruntime only accepts the input size the model was exported with
+        self.setup(config_path, weights_path, tuple(self.session.get_inputs()[0].shape[:1:-1]), "onnxruntime")
+
+    def set_backend(self, name):
+        if name != "onnxruntime":
+            raise ValueError(f"{self.weights_path} is run by onnxruntime, not by the {name} backend")
+
+    def detect_batch(self, images, confThresholds, nmsThresholds, input_size=None):
+        if input_size is not None and tuple(input_size) != self.input_size and not OnnxRuntimeNet.size_warned:
+            OnnxRuntimeNet.size_warned = True
+            print(f"{self.weights_path} only runs at its exported input size {self.input_size[0]}x{self.input_size[1]}, "
+                  "the per-camera, adaptive and overload input sizes do not apply", file=sys.stderr)
+        return super().detect_batch(images, confThresholds, nmsThresholds, self.input_size)
+
+    def forward(self, blob):
+        return self.session.run(self.output_names, {self.input_name: blob})
+
+
+def read_cfg(config_path):
+    # the [section]s of a Darknet cfg in order, with their options as strings
+    sections = []
+    for line in open(config_path):
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        if line.startswith("["):
+            sections.append((line[1:-1].strip(), {}))
+        elif "=" in line:
+            key, value = line.split("=", 1)
+            sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+
+def read_yolo_layers(config_path):
+    # anchors (pixels of the network input), box scale and classes of every [yolo] section, in the order of the network outputs
+    layers = []
+    for name, options in read_cfg(config_path):
+        if name == "yolo":
+            anchors = np.array([float(value) for value in options["anchors"].split(",")], dtype=np.float32).reshape(-1, 2)
+            mask = [int(value) for value in options["mask"].split(",")]
+            layers.append(YoloLayer(anchors[mask], float(options.get("scale_x_y", 1)), int(options["classes"])))
+    return layers
+
+
+def decode_yolo_outputs(outputs, yolo_layers, input_size, thresh=0.2):
+    # the [yolo] layers of OpenCV in NumPy: raw head maps (batch, anchors * (5 + classes), rows, cols) become the same
+    # (batch, rows * cols * anchors, 5 + classes) outputs as the Darknet network, normalized boxes, objectness and class scores
+    width, height = input_size
+    decoded = []
+    for output, layer in zip(outputs, yolo_layers):
+        count, _, rows, cols = output.shape
+        output = output.reshape(count, len(layer.anchors), 5 + layer.classes, rows, cols).transpose(0, 3, 4, 1, 2)
+        with np.errstate(over="ignore"):
+            logistic = 1 / (1 + np.exp(-output))
+            sizes = np.exp(output[..., 2:4]) * layer.anchors / np.array([width, height], dtype=np.float32)
+        offset = (layer.scale_x_y - 1) / 2
+        x = (np.arange(cols, dtype=np.float32)[:, None] + logistic[..., 0] * layer.scale_x_y - offset) / cols
+        y = (np.arange(rows, dtype=np.float32)[:, None, None] + logistic[..., 1] * layer.scale_x_y - offset) / rows
+        scores = logistic[..., 5:] * logistic[..., 4:5]
+        scores[scores <= thresh] = 0
+        layer_rows = np.concatenate([x[..., None], y[..., None], sizes, logistic[..., 4:5], scores], axis=-1)
+        decoded.append(layer_rows.reshape(count, -1, 5 + layer.classes).astype(np.float32))
+    return decoded
+
+
+def decode_batch(outputs, frame_shapes, confThresholds, nmsThresholds):
+    # decodes the raw YOLO outputs of a whole batch at once, frames of any size, cameras or tiles alike,
+    # returns one class-aware NMS filtered (classes, confidences, boxes) tuple of compact arrays per frame
+    count = len(frame_shapes)
+    # a single image gives 2D outputs, a batch gives one (rows, 5 + classes) slice per image
+    rows = np.concatenate([output.reshape(count, -1, output.shape[-1]) for output in outputs], axis=1)
+    scores = rows[:, :, 5:]
+    classes = scores.argmax(axis=2)
+    confidences = np.take_along_axis(scores, classes[:, :, None], axis=2)[:, :, 0]
+    images, keep = np.nonzero(confidences >= np.asarray(confThresholds, dtype=np.float32)[:, None])
+    rows, classes, confidences = rows[images, keep], classes[images, keep], confidences[images, keep]
+    # same integer arithmetic and clipping as cv2.dnn_DetectionModel, so both paths give identical boxes
+    frame_sizes = np.array([(width, height) for height, width in frame_shapes], dtype=np.int32)[images]
+    centers = (rows[:, 0:2] * frame_sizes.astype(np.float32)).astype(np.int32)
+    sizes = (rows[:, 2:4] * frame_sizes.astype(np.float32)).astype(np.int32)
+    boxes = np.concatenate([centers - sizes // 2, sizes], axis=1)
+    boxes[:, 0:2] = np.clip(boxes[:, 0:2], 0, frame_sizes - 1)
+    boxes[:, 2:4] = np.clip(boxes[:, 2:4], 1, frame_sizes - boxes[:, 0:2])
+    classes, confidences = classes.astype(np.int32), confidences.astype(np.float32)
+    # the NMS runs per frame: one call over the whole batch would compare the boxes of every frame with each other
+    bounds = np.searchsorted(images, np.arange(count + 1))
+    detections = []
+    for start, end, nmsThreshold in zip(bounds[:-1], bounds[1:], nmsThresholds):
+        indices = cv2.dnn.NMSBoxesBatched(boxes[start:end].tolist(), confidences[start:end].tolist(), classes[start:end].tolist(), 0, float(nmsThreshold))
+        indices = start + np.array(indices, dtype=np.int64).reshape(-1)
+        detections.append((classes[indices], confidences[indices], boxes[indices]))
+    return detections
+
+
+def available_backends():
+    return [name for name, (backend, target) in BACKENDS.items() if target in cv2.dnn.getAvailableTargets(backend)]
+
+
+def measure_latency(net, runs=5, warmup_runs=2):
+    # average time (ms) of a single frame detection on a synthetic 1280x720 frame, after a few warm-up inferences
+    frame = np.random.randint(0, 256, (720, 1280, 3), dtype=np.uint8)
+    for _ in range(warmup_runs):
+        net.detect(frame, 0.5, 0.5)
+    start = time.perf_counter()
+    for _ in range(runs):
+        net.detect(frame, 0.5, 0.5)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def select_backend(net, backends):
+    latencies = {}
+    for name in backends:
+        try:
+            net.set_backend(name)
+            latencies[name] = measure_latency(net)
+        except cv2.error:
+            print(f"Detection backend {name}: failed to run", file=sys.stderr)
+            continue
+        print(f"Detection backend {name}: {latencies[name]:0.1f} ms per frame", file=sys.stderr)
+    best = min(latencies, key=latencies.get) if latencies else "opencv"
+    net.set_backend(best)
+    return best
+
+
+def create_detection_net(config_path, weights_path, backend="cuda"):
+    # weights_path is a Darknet .weights file or an ONNX export of the same cfg (export_onnx.py)
+    if backend == "onnxruntime":
+        if weights_path.endswith(".onnx"):
+            print("Using detection backend onnxruntime", file=sys.stderr)
+            return OnnxRuntimeNet(config_path, weights_path, DEFAULT_INPUT_SIZE)
+        # e.g. the Darknet tiny model of the overload controller
+        print(f"{weights_path} is not an ONNX model, falling back to opencv", file=sys.stderr)
+        backend = "opencv"
+    net = DetectionNet(config_path, weights_path, DEFAULT_INPUT_SIZE)
+    backends = available_backends()
+    if backend == "auto":
+        backend = select_backend(net, backends)
+    elif backend not in backends:
+        print(f"Detection backend {backend} is not available in this OpenCV build, falling back to opencv", file=sys.stderr)
+        backend = "opencv"
+    net.set_backend(backend)
+    print(f"Using detection backend {backend}", file=sys.stderr)
+    return net
+
+
+def summarize_detections(classes, confidences, boxes):
+    classes = np.asarray(classes, dtype=np.int32).reshape(-1)
+    mask_count = int(np.count_nonzero(classes == 1))
+    nomask_count = len(classes) - mask_count
+    # mask_count, nomask_count = nomask_count, mask_count
+    ratio = nomask_count / (mask_count + nomask_count + 0.000001)
+    if ratio >= 0.1 and nomask_count >= 3:
+        status = "Danger"
+    elif ratio != 0 and np.isnan(ratio) is not True:
+        status = "Warning"
+    else:
+        status = "Safe"
+    return DetectionResult(classes, np.asarray(confidences, dtype=np.float32).reshape(-1), np.asarray(boxes, dtype=np.int32).reshape(-1, 4),
+                           mask_count, nomask_count, status)
+
+
+def scale_boxes(boxes, from_shape, to_shape):
+    # boxes of a frame of from_shape in pixels of the same frame at to_shape
+    scale = np.array([to_shape[1] / from_shape[1], to_shape[0] / from_shape[0]] * 2)
+    return np.round(np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * scale).astype(np.int32)
+
+
+def draw_detections(img, result):
+    for cl, score, (left, top, width, height) in zip(result.classes, result.confidences, result.boxes):
+        start_point = (int(left), int(top))
+        end_point = (int(left + width), int(top + height))
+        color = COLORS[cl]
+        img = cv2.rectangle(img, start_point, end_point, color, 2)  # draw class box
+        text = f'{LABELS[cl]}: {score:0.2f}'
+        (test_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_ITALIC, 0.6, 1)
+        end_point = (int(left + test_width + 2), int(top - text_height - 2))
+        img = cv2.rectangle(img, start_point, end_point, color, -1)
+        cv2.putText(img, text, start_point, cv2.FONT_ITALIC, 0.6, COLORS[1 - cl], 1)  # print class type with score
+    return img
+
+
+class BatchInference:
+    # collects the latest frame of every camera and runs them through the network in a single forward pass
+    def __init__(self, net, max_batch_size=8, max_wait=15):
+        self.net = net
+        self.nets = {(net.config_path, net.weights_path): net}
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait / 1000
+        self.pending = {}
+        self.forward_seconds = 0.0
+
+    def submit(self, key, img, confThreshold, nmsThreshold, input_size=None):
+        # a newer frame replaces the pending one of the same camera, but keeps its place in the queue
+        submit_time = self.pending[key][3] if key in self.pending else time.monotonic()
+        self.pending[key] = (img, confThreshold, nmsThreshold, submit_time, input_size or self.net.input_size)
+
+    def discard(self, key):
+        self.pending.pop(key, None)
+
+    def clear(self):
+        self.pending = {}
+
+    def close(self):
+        self.clear()
+
+    def queue_depth(self):
+        return len(self.pending)
+
+    def forward_time(self):
+        # time the network spent on the frames returned so far, without the time they waited for a batch
+        return self.forward_seconds
+
+    def set_model(self, config_path, weights_path):
+        # a network is kept once loaded, so switching back and forth does not read its weights again
+        if (config_path, weights_path) not in self.nets:
+            self.nets[config_path, weights_path] = create_detection_net(config_path, weights_path, self.net.backend)
+        self.net = self.nets[config_path, weights_path]
+
+    def poll(self, expected=None):
+        if not self.pending:
+            return []
+        batch_size = min(expected or self.max_batch_size, self.max_batch_size)
+        oldest = min(item[3] for item in self.pending.values())
+        if len(self.pending) < batch_size and time.monotonic() - oldest < self.max_wait:
+            return []
+        keys = sorted(self.pending, key=lambda key: self.pending[key][3])
+        # a batch shares one input size, the one of the oldest frame
+        input_size = self.pending[keys[0]][4]
+        keys = [key for key in keys if self.pending[key][4] == input_size][:self.max_batch_size]
+        batch = [self.pending.pop(key) for key in keys]
+        start = time.perf_counter()
+        detections = self.net.detect_batch([item[0] for item in batch], [item[1] for item in batch], [item[2] for item in batch], input_size)
+        self.forward_seconds += time.perf_counter() - start
+        return [(key, item[0], detection) for key, item, detection in zip(keys, batch, detections)]
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import cv2
+import numpy as np
+
+from detection import DEFAULT_INPUT_SIZE, DetectionNet, OnnxRuntimeNet, read_cfg
+from benchmark import MODELS, percentiles, synthetic_frames, time_calls
+from tracking import box_iou
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def read_darknet_weights(weights_path):
+    # the float32 values of a Darknet .weights file, after its version header and the count of training images
+    with open(weights_path, "rb") as weights_file:
+        major, minor, revision = np.fromfile(weights_file, dtype=np.int32, count=3)
+        np.fromfile(weights_file, dtype=np.int64 if major * 10 + minor >= 2 else np.int32, count=1)
+        return np.fromfile(weights_file, dtype=np.float32)
+
+
+class DarknetGraph:
+    # rebuilds a Darknet cfg as ONNX nodes, one method per section type, each returning the name and channels of its output
+    def __init__(self, weights):
+        from onnx import helper, numpy_helper
+        self.helper = helper
+        self.numpy_helper = numpy_helper
+        self.weights = weights
+        self.offset = 0
+        self.nodes = []
+        self.initializers = []
+
+    def take(self, count):
+        if self.offset + count > len(self.weights):
+            raise ValueError("the weights file is shorter than its cfg, they do not belong together")
+        values = self.weights[self.offset:self.offset + count]
+        self.offset += count
+        return values
+
+    def constant(self, name, array):
+        self.initializers.append(self.numpy_helper.from_array(np.ascontiguousarray(array), name))
+        return name
+
+    def node(self, op_type, inputs, name, **attributes):
+        self.nodes.append(self.helper.make_node(op_type, inputs, [name], name=name, **attributes))
+        return name
+
+    def activation(self, name, x, kind):
+        if kind == "linear":
+            return x
+        if kind == "leaky":
+            return self.node("LeakyRelu", [x], f"{name}_leaky", alpha=0.1)
+        if kind == "logistic":
+            return self.node("Sigmoid", [x], f"{name}_logistic")
+        if kind == "mish":
+            # x * tanh(softplus(x)), the Mish operator only exists from opset 18
+            softplus = self.node("Softplus", [x], f"{name}_softplus")
+            return self.node("Mul", [x, self.node("Tanh", [softplus], f"{name}_tanh")], f"{name}_mish")
+        raise ValueError(f"unsupported activation {kind}")
+
+    def convolutional(self, name, x, channels, options):
+        filters, size, stride = int(options["filters"]), int(options["size"]), int(options.get("stride", 1))
+        if int(options.get("groups", 1)) != 1:
+            raise ValueError("grouped convolutions are not supported")
+        pad = size // 2 if int(options.get("pad", 0)) else int(options.get("padding", 0))
+        bias = self.take(filters)
+        if int(options.get("batch_normalize", 0)):
+            # the batch normalization is folded into the convolution, as the Darknet importer of OpenCV does at inference
+            scale, mean, variance = self.take(filters), self.take(filters), self.take(filters)
+            factor = scale / np.sqrt(variance + 1e-6)
+            weights = self.take(filters * channels * size * size).reshape(filters, channels, size, size) * factor[:, None, None, None]
+            bias = bias - mean * factor
+        else:
+            weights = self.take(filters * channels * size * size).reshape(filters, channels, size, size)
+        output = self.node("Conv", [x, self.constant(f"{name}_weights", weights.astype(np.float32)), self.constant(f"{name}_bias", bias.astype(np.float32))],
+                           name, kernel_shape=[size, size], strides=[stride, stride], pads=[pad] * 4)
+        return self.activation(name, output, options.get("activation", "logistic")), filters
+
+    def maxpool(self, name, x, channels, options):
+        size = int(options["size"])
+        stride = int(options.get("stride", size))
+        # Darknet pads size - 1 pixels, the larger half after the frame, so a stride 2 halves the map and a stride 1 keeps it
+        begin = (size - 1) // 2
+        end = size - 1 - begin
+        return self.node("MaxPool", [x], name, kernel_shape=[size, size], strides=[stride, stride], pads=[begin, begin, end, end]), channels
+
+    def upsample(self, name, x, channels, options):
+        stride = float(options.get("stride", 2))
+        scales = self.constant(f"{name}_scales", np.array([1, 1, stride, stride], dtype=np.float32))
+        return self.node("Resize", [x, "", scales], name, mode="nearest", coordinate_transformation_mode="asymmetric", nearest_mode="floor"), channels
+
+    def route(self, name, layers, options):
+        inputs = [layers[int(index)] if int(index) >= 0 else layers[len(layers) + int(index)] for index in options["layers"].split(",")]
+        groups, group_id = int(options.get("groups", 1)), int(options.get("group_id", 0))
+        if groups > 1:
+            # the group_id-th slice of the channels of a single layer
+            x, channels = inputs[0]
+            channels //= groups
+            starts, ends, axes = [self.constant(f"{name}_{key}", np.array([value], dtype=np.int64))
+                                  for key, value in (("starts", channels * group_id), ("ends", channels * (group_id + 1)), ("axes", 1))]
+            return self.node("Slice", [x, starts, ends, axes], name), channels
+        if len(inputs) == 1:
+            return inputs[0]
+        return self.node("Concat", [x for x, channels in inputs], name, axis=1), sum(channels for x, channels in inputs)
+
+    def shortcut(self, name, x, channels, layers, options):
+        index = int(options["from"])
+        other = layers[index if index >= 0 else len(layers) + index][0]
+        return self.activation(name, self.node("Add", [x, other], name), options.get("activation", "linear")), channels
+
+
+def build_model(config_path, weights_path, input_size=DEFAULT_INPUT_SIZE, opset=13):
+    # the network up to the last convolution of every head, outputs yolo_0, yolo_1, ... in the order of the [yolo] sections,
+    # the [yolo] layers themselves are decoded by detection.decode_yolo_outputs. The batch is dynamic but the input size is
+    # declared: the ONNX importer of OpenCV cannot infer the shapes of an unknown one, and still reshapes the network to any size
+    from onnx import TensorProto, checker, helper
+    sections = read_cfg(config_path)
+    graph = DarknetGraph(read_darknet_weights(weights_path))
+    x, channels = "images", int(sections[0][1].get("channels", 3))
+    layers = []
+    outputs = []
+    for index, (section, options) in enumerate(sections[1:]):
+        name = f"{section}_{index}"
+        if section == "convolutional":
+            x, channels = graph.convolutional(name, x, channels, options)
+        elif section == "maxpool":
+            x, channels = graph.maxpool(name, x, channels, options)
+        elif section == "upsample":
+            x, channels = graph.upsample(name, x, channels, options)
+        elif section == "route":
+            x, channels = graph.route(name, layers, options)
+        elif section == "shortcut":
+            x, channels = graph.shortcut(name, x, channels, layers, options)
+        elif section == "yolo":
+            output = graph.node("Identity", [x], f"yolo_{len(outputs)}")
+            outputs.append(helper.make_tensor_value_info(output, TensorProto.FLOAT, ["batch", channels, f"rows_{len(outputs)}", f"cols_{len(outputs)}"]))
+        else:
+            raise ValueError(f"unsupported cfg section [{section}]")
+        layers.append((x, channels))
+    if graph.offset != len(graph.weights):
+        raise ValueError(f"{len(graph.weights) - graph.offset} values of the weights file are not used by its cfg, they do not belong together")
+    inputs = [helper.make_tensor_value_info("images", TensorProto.FLOAT, ["batch", int(sections[0][1].get("channels", 3)), input_size[1], input_size[0]])]
+    model = helper.make_model(helper.make_graph(graph.nodes, os.path.basename(config_path), inputs, outputs, graph.initializers),
+                              opset_imports=[helper.make_opsetid("", opset)], producer_name="export_onnx.py", ir_version=8)
+    helper.set_model_props(model, {"darknet_cfg": os.path.basename(config_path)})
+    checker.check_model(model)
+    return model
+
+
+def read_frames(frames_dir, limit=None):
+    # the images of a folder in name order, e.g. frames saved from the cameras of the site
+    paths = sorted(path for path in glob.glob(os.path.join(frames_dir, "*")) if path.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    frames = [frame for frame in (cv2.imread(path) for path in paths) if frame is not None]
+    if not frames:
+        raise ValueError(f"no images found in {frames_dir}")
+    return frames
+
+
+def quantize_model(onnx_path, quantized_path, frames, input_size, exclude_nodes=()):
+    # int8 weights and activations (QDQ format), the activation ranges are calibrated on frames preprocessed like the cameras
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.blobs = iter([cv2.dnn.blobFromImage(frame, 1.0 / 255, input_size, swapRB=True, crop=False) for frame in frames])
+
+        def get_next(self):
+            blob = next(self.blobs, None)
+            return None if blob is None else {"images": blob}
+
+    quantize_static(onnx_path, quantized_path, FrameReader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, nodes_to_exclude=list(exclude_nodes))
+
+
+def head_convolutions(model):
+    # the last convolution of every head, kept in float32 by the quantization: the box coordinates are the most sensitive to it
+    producers = {node.output[0]: node for node in model.graph.node}
+    return [producers[node.input[0]].name for node in model.graph.node if node.op_type == "Identity" and node.output[0].startswith("yolo_")]
+
+
+def match_detections(reference, detections, min_iou=0.5):
+    # greedy one to one matching of the boxes of the same class, the most confident reference boxes first, returns the IoUs of the pairs
+    reference_classes, reference_confidences, reference_boxes = [np.asarray(value) for value in reference]
+    classes, confidences, boxes = [np.asarray(value) for value in detections]
+    boxes = boxes.reshape(-1, 4).astype(np.float64)
+    free = np.ones(len(boxes), dtype=bool)
+    ious = []
+    for i in np.argsort(-reference_confidences.reshape(-1)):
+        candidates = np.nonzero(free & (classes.reshape(-1) == reference_classes.reshape(-1)[i]))[0]
+        if not len(candidates):
+            continue
+        overlaps = box_iou(reference_boxes.reshape(-1, 4)[i], boxes[candidates])[0]
+        best = int(np.argmax(overlaps))
+        if overlaps[best] >= min_iou:
+            free[candidates[best]] = False
+            ious.append(float(overlaps[best]))
+    return ious
+
+
+def compare(reference, nets, frames, confThreshold, nmsThreshold, runs):
+    # latency of single frame detections and agreement of every net with the reference (the Darknet model)
+    expected = [reference.detect(frame, confThreshold, nmsThreshold) for frame in frames]
+    report = {}
+    for name, net in [("darknet", reference)] + nets:
+        detections = [net.detect(frame, confThreshold, nmsThreshold) for frame in frames]  # also warms the net up
+        times = time_calls(lambda: [net.detect(frame, confThreshold, nmsThreshold) for frame in frames[:1]], runs)
+        matched, ious = 0, []
+        for reference_detections, frame_detections in zip(expected, detections):
+            frame_ious = match_detections(reference_detections, frame_detections)
+            matched += len(frame_ious)
+            ious += frame_ious
+        reference_count = sum(len(classes) for classes, confidences, boxes in expected)
+        count = sum(len(classes) for classes, confidences, boxes in detections)
+        report[name] = {"backend": net.backend, "file": net.weights_path, "file_mb": round(os.path.getsize(net.weights_path) / 1e6, 1),
+                        "latency": percentiles(times), "detections": count, "reference_detections": reference_count, "matched": matched,
+                        # share of the reference faces found again and of the detections the reference agrees with
+                        "recall": round(matched / reference_count, 4) if reference_count else 1.0,
+                        "precision": round(matched / count, 4) if count else 1.0,
+                        "mean_iou": round(float(np.mean(ious)), 4) if ious else None}
+    return report
+
+
+def export(config_path, weights_path, output_dir, calibration_dir=None, calibration_frames=100, input_size=DEFAULT_INPUT_SIZE):
+    # writes NAME.onnx, and NAME.int8.onnx when calibration frames are given, returns their paths
+    import onnx
+    name = os.path.splitext(os.path.basename(weights_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    onnx_path = os.path.join(output_dir, name + ".onnx")
+    start = time.perf_counter()
+    model = build_model(config_path, weights_path, input_size)
+    onnx.save(model, onnx_path)
+    print(f"{config_path} + {weights_path} -> {onnx_path} in {time.perf_counter() - start:0.1f} s")
+    paths = [onnx_path]
+    if calibration_dir:
+        quantized_path = os.path.join(output_dir, name + ".int8.onnx")
+        start = time.perf_counter()
+        frames = read_frames(calibration_dir, calibration_frames)
+        quantize_model(onnx_path, quantized_path, frames, input_size, head_convolutions(model))
+        print(f"{onnx_path} -> {quantized_path}, calibrated on {len(frames)} frames in {time.perf_counter() - start:0.1f} s")
+        paths.append(quantized_path)
+    return paths
+
+
+def run(config_path, weights_path, output_dir, calibration_dir, calibration_frames, input_size, frames_dir, confThreshold, nmsThreshold, runs):
+    paths = export(config_path, weights_path, output_dir, calibration_dir, calibration_frames, input_size)
+    frames = read_frames(frames_dir, calibration_frames) if frames_dir else synthetic_frames(8)
+    reference = DetectionNet(config_path, weights_path, input_size)
+    nets = [("onnx opencv", DetectionNet(config_path, paths[0], input_size))]
+    try:
+        nets += [(f"{kind} onnxruntime", OnnxRuntimeNet(config_path, path, input_size)) for kind, path in zip(["onnx", "int8"], paths)]
+    except ImportError:
+        print("onnxruntime is not installed, the export is only compared on the OpenCV backend")
+    if len(paths) > 1:
+        try:
+            nets.append(("int8 opencv", DetectionNet(config_path, paths[1], input_size)))
+        except cv2.error as error:
+            print(f"OpenCV cannot run {paths[1]}: {error}")
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config_path, "input_size": list(input_size), "frames": len(frames),
+            "confidence_threshold": confThreshold, "nms_threshold": nmsThreshold, "runs": runs,
+            "environment": {"python": platform.python_version(), "opencv": cv2.__version__, "machine": platform.machine(), "cpu_count": os.cpu_count()},
+            "models": compare(reference, nets, frames, confThreshold, nmsThreshold, runs)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a Darknet network to ONNX, optionally quantize it to int8, and compare the exports with the original")
+    parser.add_argument("--model", default="full", choices=list(MODELS), help="network configuration to convert (yolo_utils cfg)")
+    parser.add_argument("--config", help="Darknet cfg, instead of --model")
+    parser.add_argument("--weights", required=True, help="Darknet weights of the cfg")
+    parser.add_argument("--output-dir", default="yolo_utils", help="folder the .onnx files are written to")
+    parser.add_argument("--calibration", help="folder of frames (jpg/png) from the cameras, also writes an int8 quantized model calibrated on them")
+    parser.add_argument("--calibration-frames", type=int, default=100, help="maximum number of frames used for the calibration and the comparison")
+    parser.add_argument("--input-size", type=int, default=DEFAULT_INPUT_SIZE[0], help="network input size (multiple of 32) of the calibration and the comparison")
+    parser.add_argument("--frames", help="folder of frames the exports are compared on, defaults to the calibration frames, then to random frames")
+    parser.add_argument("--confidence", type=float, default=0.5, help="confidence threshold of the compared detections")
+    parser.add_argument("--nms", type=float, default=0.4, help="NMS threshold of the compared detections")
+    parser.add_argument("--runs", type=int, default=20, help="timed single frame detections per model")
+    parser.add_argument("--report", default="onnx_report.json", help="JSON file the comparison is written to, - writes it to the standard output")
+    args = parser.parse_args()
+    try:
+        import onnx
+    except ImportError:
+        parser.error("the conversion needs onnx (pip install onnx)")
+    if args.calibration:
+        try:
+            import onnxruntime
+        except ImportError:
+            parser.error("--calibration needs onnxruntime (pip install onnxruntime)")
+    input_size = (args.input_size, args.input_size)
+    report = run(args.config or MODELS[args.model], args.weights, args.output_dir, args.calibration, args.calibration_frames, input_size,
+                 args.frames or args.calibration, args.confidence, args.nms, args.runs)
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"Comparison written to {args.report}")
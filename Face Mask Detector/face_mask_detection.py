@@ -1,104 +1,51 @@
-import os
 import sys
+import argparse
 import cv2
-import numpy as np
-from pathlib import Path
 from datetime import datetime
-from PyQt5.QtCore import QTimer, QRegExp, Qt
+from PyQt5.QtCore import QTimer, QRegExp, Qt, pyqtSignal
 from PyQt5.QtGui import QImage, QPixmap, QColor, QRegExpValidator
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTableWidgetItem, QWidget, QMessageBox
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTableWidgetItem, QWidget, QMessageBox, QProgressBar
 
 from start_menu import *
 from new_cam_menu import *
 from main_menu import *
+import settings
+from settings import cam_list_filename
+from detection import *
+from camera_stream import CameraStream, read_camera_list
+from model_loader import ModelLoader
+from reconnect import ReconnectScheduler
+from overload import create_overload_controller, apply_level
+from metrics import MetricsServer, render_metrics
+from snapshot_writer import get_snapshot_writer, close_snapshot_writer
+
+
+def to_qimage(image):
+    height, width, channel = image.shape
+    step = channel * width
+    if hasattr(QImage, "Format_BGR888"):
+        return QImage(image.data, width, height, step, QImage.Format_BGR888)
+    # Qt versions older than 5.14 have no BGR image format, the overlay buffer is converted in place
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return QImage(image.data, width, height, step, QImage.Format_RGB888)
+
+
+class Camera(CameraStream, QTimer):
+    frame_ready = pyqtSignal()  # emitted by the grabber thread, delivered on the thread of the interface
 
-LABELS = ["Without Mask", "Mask"]
-COLORS = [[0, 0, 255], [0, 255, 0]]
-# LABELS = ["Mask", "Without Mask"]
-# COLORS = [[0, 255, 0], [0, 0, 255]]
-weightsPath = "yolo_utils/yolov4_face_mask.weights"
-configPath = "yolo_utils/yolov4-mask.cfg"
-# weightsPath = "yolo_utils/yolov4-tiny-mask.weights"
-# configPath = "yolo_utils/yolov4-tiny-mask.cfg"
-photo_path = "photos"
-camera_list_path = "resources/camera_list.txt"
-connect_log_path = "resources/connect_history.log"
-
-photo_dir = Path(photo_path)
-photo_dir.mkdir(parents=True, exist_ok=True)
-cam_list_filename = Path(camera_list_path)
-cam_list_filename.touch(exist_ok=True)
-connect_log_filename = Path(connect_log_path)
-connect_log_filename.touch(exist_ok=True)
-
-
-def create_detection_net(config_path, weights_path):
-    net = cv2.dnn_DetectionModel(config_path, weights_path)
-    net.setInputSize(640, 640)
-    net.setInputScale(1.0 / 255)
-    net.setInputSwapRB(True)
-    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-    return net
-
-
-def get_processed_image(img, net, confThreshold, nmsThreshold):
-    mask_count = 0
-    nomask_count = 0
-    classes, confidences, boxes = net.detect(img, confThreshold, nmsThreshold)
-    for cl, score, (left, top, width, height) in zip(classes, confidences, boxes):
-        mask_count += cl
-        nomask_count += (1 - cl)
-        # mask_count += (1 - cl)
-        # nomask_count += cl
-        start_point = (int(left), int(top))
-        end_point = (int(left + width), int(top + height))
-        color = COLORS[cl]
-        img = cv2.rectangle(img, start_point, end_point, color, 2)  # draw class box
-        text = f'{LABELS[cl]}: {score:0.2f}'
-        (test_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_ITALIC, 0.6, 1)
-        end_point = (int(left + test_width + 2), int(top - text_height - 2))
-        img = cv2.rectangle(img, start_point, end_point, color, -1)
-        cv2.putText(img, text, start_point, cv2.FONT_ITALIC, 0.6, COLORS[1 - cl], 1)  # print class type with score
-    ratio = nomask_count / (mask_count + nomask_count + 0.000001)
-    if ratio >= 0.1 and nomask_count >= 3:
-        status = "Danger"
-    elif ratio != 0 and np.isnan(ratio) is not True:
-        status = "Warning"
-    else:
-        status = "Safe"
-    return img, status, mask_count, nomask_count
-
-
-class Camera(QTimer):
     def __init__(self, camName, camID, confThreshold=0.5, nmsThreshold=0.5):
-        super().__init__()
-        self.camName = camName
-        self.camID = camID
-        self.confThreshold = confThreshold
-        self.nmsThreshold = nmsThreshold
+        QTimer.__init__(self)
+        CameraStream.__init__(self, camName, camID, confThreshold, nmsThreshold)
         self.viewable = False
-        self.status = "Not Connected"
-        self.prev_status = "Not Connected"
-        self.last_image = None
         self.camera_name_item = QTableWidgetItem(self.camName)
         self.camera_name_item.setTextAlignment(Qt.AlignCenter)
         self.camera_status_item = QTableWidgetItem(self.status)
         self.camera_status_item.setTextAlignment(Qt.AlignCenter)
-        self.cam = cv2.VideoCapture(self.camID)
+        # the camera runs when a frame arrives, the timer only wakes it up at the end of the fps limit and for the stall check
+        self.setSingleShot(True)
         self.timeout.connect(self.camera_run)
-
-    def start_camera(self):
-        self.cam = cv2.VideoCapture(self.camID)
-        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-
-    def take_photo(self):
-        today = datetime.now().strftime("%d.%m.%Y")
-        photo_dir_today = Path(os.path.join(photo_path, today, self.status))
-        photo_dir_today.mkdir(parents=True, exist_ok=True)
-        image_name = self.camName + "_" + datetime.now().strftime("%d.%m.%Y_%H.%M.%S") + ".jpg"
-        cv2.imwrite(os.path.join(photo_dir_today, image_name), self.last_image)
+        self.frame_ready.connect(self.camera_run)
+        self.on_frame = self.frame_ready.emit
 
     def view_disconnected_cam(self):
         mainMenu.ui.image_label.setStyleSheet("color: rgb(210, 105, 30);")
@@ -113,69 +60,70 @@ class Camera(QTimer):
         mainMenu.ui.status_type_label.setStyleSheet(status_stylesheet)
 
     def camera_run(self):
+        if self.grabber is None and self.status != "Not Connected":
+            return  # stopped with the main menu, a frame signal was still queued
+        with self.metrics.time("camera_run"):
+            self.run_once()
+        if self.status != "Not Connected":
+            self.start(int(self.wake_delay() * 1000))
+
+    def run_once(self):
         if self.status != "Not Connected":
             try:
-                ret, image = self.cam.read()
-                self.last_image = image.copy()
-                image, status, mask_count, nomask_count = get_processed_image(image, mainMenu.net, self.confThreshold, self.nmsThreshold)
-                self.status = status
-                if status == "Safe":
-                    self.camera_name_item.setForeground(QColor(21, 200, 8))
-                    self.camera_status_item.setForeground(QColor(21, 200, 8))
-                    status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: rgb(21, 200, 8);"
-                elif status == "Warning":
-                    self.camera_name_item.setForeground(QColor("yellow"))
-                    self.camera_status_item.setForeground(QColor("yellow"))
-                    status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: yellow;"
-                else:
-                    self.camera_name_item.setForeground(QColor("red"))
-                    self.camera_status_item.setForeground(QColor("red"))
-                    status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: red;"
-                self.camera_status_item.setText(self.status)
-                if self.viewable is True:
-                    mainMenu.ui.image_label.setStyleSheet("color: rgb(255, 255, 255);")
-                    mainMenu.ui.image_label.setText("Select a Camera")
-                    mainMenu.ui.mask_count_label.setText(f'Mask Count:  {mask_count}')
-                    mainMenu.ui.no_mask_count_label.setText(f'No Mask Count:  {nomask_count}')
-                    mainMenu.ui.status_label.setText('Status:')
-                    mainMenu.ui.status_type_label.setText(status)
-                    mainMenu.ui.status_type_label.setStyleSheet(status_stylesheet)
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                    height, width, channel = image.shape
-                    step = channel * width
-                    qImg = QImage(image.data, width, height, step, QImage.Format_RGB888)
-                    mainMenu.ui.image_label.setPixmap(QPixmap.fromImage(qImg))
+                image, detections = self.next_frame()
+                if image is not None:
+                    if detections is None:
+                        mainMenu.inference.submit(self, image, self.confThreshold, self.nmsThreshold, self.detection_input_size(), self.detection_regions(image))
+                        mainMenu.wake_inference()
+                    else:
+                        self.show_detections(image, detections)
+                    self.camera_status_item.setToolTip(f"Detections skipped by the motion gate: {self.motion_gate.skipped} of {self.motion_gate.frame_count} frames")
             except:
-                with open(connect_log_path, "a") as connect_log:
-                    connect_log.write(datetime.now().strftime("%d/%m/%Y - %H:%M:%S ->\t") + self.camName + " (ID: " + str(self.camID) + ") disconnected from the system.\n\n")
-                self.status = "Not Connected"
+                mainMenu.inference.discard(self)
+                self.close_stream()
                 self.camera_name_item.setForeground(QColor(210, 105, 30))
                 self.camera_status_item.setForeground(QColor(210, 105, 30))
                 self.camera_status_item.setText(self.status)
-                self.cam.release()
                 if self.viewable is True:
                     self.view_disconnected_cam()
 
-        else:
-            self.cam = cv2.VideoCapture(self.camID)
-            if self.cam.isOpened() and self.cam.get(cv2.CAP_PROP_FPS) != 0:
-                with open(connect_log_path, "a") as connect_log:
-                    connect_log.write(datetime.now().strftime("%d/%m/%Y - %H:%M:%S ->\t") + self.camName + " (ID: " + str(self.camID) + ") connected to the system.\n\n")
-                self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-                self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-                self.status = "Safe"
-            elif self.viewable is True:
-                self.view_disconnected_cam()
-        # automatically take a photo when the status of the camera switches to "Warning" or "Danger"
-        if self.prev_status == "Safe" or self.prev_status == "Not Connected":
-            if self.status == "Warning" or self.status == "Danger":
-                self.take_photo()
-        elif self.prev_status == "Warning" and self.status == "Danger":
-            self.take_photo()
-        elif self.prev_status == "Danger" and self.status == "Warning":
-            self.take_photo()
+        elif self.viewable is True:
+            self.view_disconnected_cam()
         self.prev_status = self.status
 
+    def show_detections(self, image, detections):
+        result = self.update_detections(image, detections)
+        if result is None:
+            return
+        status = result.status
+        if status == "Safe":
+            self.camera_name_item.setForeground(QColor(21, 200, 8))
+            self.camera_status_item.setForeground(QColor(21, 200, 8))
+            status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: rgb(21, 200, 8);"
+        elif status == "Warning":
+            self.camera_name_item.setForeground(QColor("yellow"))
+            self.camera_status_item.setForeground(QColor("yellow"))
+            status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: yellow;"
+        else:
+            self.camera_name_item.setForeground(QColor("red"))
+            self.camera_status_item.setForeground(QColor("red"))
+            status_stylesheet = "border: transparent; background-color: transparent; font: 28pt \"Gill Sans MT\"; color: red;"
+        self.camera_status_item.setText(self.status)
+        if self.viewable is True:
+            mainMenu.ui.image_label.setStyleSheet("color: rgb(255, 255, 255);")
+            mainMenu.ui.image_label.setText("Select a Camera")
+            mainMenu.ui.mask_count_label.setText(f'Mask Count:  {result.mask_count}')
+            mainMenu.ui.no_mask_count_label.setText(f'No Mask Count:  {result.nomask_count}')
+            mainMenu.ui.status_label.setText('Status:')
+            mainMenu.ui.status_type_label.setText(status)
+            mainMenu.ui.status_type_label.setStyleSheet(status_stylesheet)
+            with self.metrics.time("draw"):
+                image = draw_detections(self.overlay(self.last_image), result)
+                if self.regions:
+                    cv2.polylines(image, [region.points for region in self.regions], True, (255, 255, 0), 1)
+            with self.metrics.time("display"):
+                mainMenu.ui.image_label.setPixmap(QPixmap.fromImage(to_qimage(image)))
+
 
 class MainMenu(QMainWindow):
     def __init__(self):
@@ -186,7 +134,14 @@ class MainMenu(QMainWindow):
         header = self.ui.camera_table.horizontalHeader()
         header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
         header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
-        self.net = create_detection_net(configPath, weightsPath)
+        self.net, self.inference = None, None  # set by the model loader once the network is loaded and warmed up
+        self.overload = create_overload_controller()
+        self.metrics_server = MetricsServer(settings.metrics_port, lambda: render_metrics(self.camera_list, self.inference, get_snapshot_writer(), self.overload)) if settings.metrics_port else None
+        self.inference_timer = QTimer()
+        self.inference_timer.timeout.connect(self.run_inference)
+        self.reconnect = ReconnectScheduler(settings.reconnect_workers, settings.reconnect_interval, settings.reconnect_max_interval)
+        self.reconnect_timer = QTimer()
+        self.reconnect_timer.timeout.connect(self.connect_cameras)
         self.camera_list = []
         self.current_camera = None
         self.ui.camera_select.activated.connect(self.change_cam)
@@ -211,25 +166,62 @@ class MainMenu(QMainWindow):
 
     def start_cameras(self):
         for camera in self.camera_list:
-            camera.start_camera()
-            camera.start(30)
+            camera.max_fps = self.overload.current().max_fps
+            camera.max_input_size = self.overload.current().max_input_size
+        self.reconnect_timer.start(50)
 
     def stop_cameras(self):
+        self.inference_timer.stop()
+        self.reconnect_timer.stop()
+        self.reconnect.clear()
+        if self.inference is not None:
+            self.inference.clear()
         for camera in self.camera_list:
             camera.stop()
-            camera.cam.release()
+            camera.on_frame = None
+            camera.stop_camera()
+
+    def wake_inference(self):
+        # the inference is only polled while frames are inside it
+        if not self.inference_timer.isActive():
+            self.inference_timer.start(5)
+
+    def run_inference(self):
+        connected_cameras = [camera for camera in self.camera_list if camera.status != "Not Connected"]
+        for camera, image, detections in self.inference.poll(len(connected_cameras)):
+            camera.detection_done(image, detections)
+            self.overload.observe(camera.detect_latency)
+            if camera.frame_waiting():
+                # with every_frame and fast pacing the next frame waited for this detection
+                camera.camera_run()
+        if self.overload.update():
+            level = self.overload.current()
+            apply_level(level, self.camera_list, self.inference)
+            self.ui.statusbar.showMessage("" if self.overload.level == 0 else f"Overloaded, degraded to: {level.name}")
+        if self.inference.queue_depth() == 0:
+            self.inference_timer.stop()
+
+    def connect_cameras(self):
+        # the streams are opened by the scheduler threads, only confirmed streams join the cameras here
+        for camera, cam in self.reconnect.poll([camera for camera in self.camera_list if camera.status == "Not Connected"]):
+            camera.open_stream(cam)
+            # a source hanging before its first frame never signals one, the timer still runs the stall check
+            camera.start(int(camera.wake_delay() * 1000))
 
     def change_cam(self, i):
         self.current_camera = self.camera_list[i]
         for camera in self.camera_list:
             camera.viewable = False
         self.current_camera.viewable = True
+        self.current_camera.camera_run()
 
     def take_photo(self):
-        if self.current_camera is not None and self.current_camera.status != "Not Connected":
-            image_name = self.current_camera.camName + "_" + datetime.now().strftime("%d.%m.%Y_%H.%M.%S") + ".jpg"
-            cv2.imwrite(os.path.join(photo_path, image_name), self.current_camera.last_image)
-            QTimer.singleShot(0, lambda: self.ui.photo_taken_notification.setText("Photo Taken!"))
+        if self.current_camera is not None and self.current_camera.status != "Not Connected" and self.current_camera.last_image is not None:
+            image_name = self.current_camera.camName + "_" + datetime.now().strftime("%d.%m.%Y_%H.%M.%S")
+            if get_snapshot_writer().write(settings.photo_path, image_name, self.current_camera.last_image.copy()):
+                QTimer.singleShot(0, lambda: self.ui.photo_taken_notification.setText("Photo Taken!"))
+            else:
+                QTimer.singleShot(0, lambda: self.ui.photo_taken_notification.setText("Too many photos waiting!"))
         else:
             QTimer.singleShot(0, lambda: self.ui.photo_taken_notification.setText("Camera not available!"))
         QTimer.singleShot(2000, lambda: self.ui.photo_taken_notification.setText(""))
@@ -258,6 +250,29 @@ class StartMenu(QMainWindow):
         self.ui.camera_table.cellDoubleClicked.connect(self.show_cam_info)
         self.camera_dict = {}
         self.get_camera_list(cam_list_filename)
+        # the model loads in the background while the camera list is edited, the main menu opens once it is ready
+        self.load_progress = QProgressBar()
+        self.load_progress.setMaximumWidth(200)
+        self.ui.statusbar.addPermanentWidget(self.load_progress)
+        self.ui.main_menu_button.setEnabled(False)
+        self.loader = ModelLoader()
+        self.loader.start()
+        self.loader_timer = QTimer()
+        self.loader_timer.timeout.connect(self.check_loader)
+        self.loader_timer.start(100)
+
+    def check_loader(self):
+        self.load_progress.setValue(int(self.loader.progress * 100))
+        self.ui.statusbar.showMessage(self.loader.message)
+        if self.loader.error is not None:
+            self.loader_timer.stop()
+            self.load_progress.hide()
+        elif not self.loader.is_alive():
+            self.loader_timer.stop()
+            self.load_progress.hide()
+            mainMenu.net, mainMenu.inference = self.loader.net, self.loader.inference
+            self.ui.main_menu_button.setEnabled(True)
+            QTimer.singleShot(5000, self.ui.statusbar.clearMessage)
 
     def insert_dict_in_table(self):
         for camera in self.camera_dict:
@@ -271,14 +286,9 @@ class StartMenu(QMainWindow):
             self.ui.camera_table.setItem(current_row, 1, cam_id)
 
     def get_camera_list(self, cam_list_filename):
-        self.camera_dict = {}
         self.ui.camera_table.clearContents()
         self.ui.camera_table.setRowCount(0)
-        for cam_line in [cam_line.strip() for cam_line in open(cam_list_filename)]:
-            if cam_line.split(" ")[1].isdigit():
-                self.camera_dict[cam_line.split(" ")[0]] = int(cam_line.split(" ")[1])
-            else:
-                self.camera_dict[cam_line.split(" ")[0]] = cam_line.split(" ")[1]
+        self.camera_dict = read_camera_list(cam_list_filename)
         self.insert_dict_in_table()
 
     def update_camera_list(self, cam_list_filename):
@@ -371,9 +381,23 @@ class NewCamMenu(QWidget):
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Face Mask Detector using YOLOv4")
+    settings.add_arguments(parser, BACKENDS)
+    args, qt_args = parser.parse_known_args()
+    settings.apply_arguments(args)
+    settings.create_files()
+    app = QApplication(sys.argv[:1] + qt_args)
     startMenu = StartMenu()
     newCameraMenu = NewCamMenu()
     mainMenu = MainMenu()
     startMenu.show()
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    # the grabber threads are stopped before Qt and the interpreter shut down under them
+    mainMenu.stop_cameras()
+    if mainMenu.inference is not None:
+        mainMenu.inference.close()
+    mainMenu.reconnect.close()
+    close_snapshot_writer()
+    if mainMenu.metrics_server is not None:
+        mainMenu.metrics_server.close()
+    sys.exit(exit_code)
@@ -0,0 +1,147 @@
+import sys
+import json
+import signal
+import socket
+import argparse
+import threading
+from datetime import datetime
+
+import settings
+from detection import BACKENDS, LABELS
+from camera_stream import CameraStream, read_camera_list
+from model_loader import ModelLoader
+from reconnect import ReconnectScheduler
+from overload import create_overload_controller, apply_level
+from metrics import MetricsServer, render_metrics
+from snapshot_writer import get_snapshot_writer, close_snapshot_writer
+
+
+class SocketOutput:
+    # serves the JSON lines to every client connected to a local TCP port, a client that cannot keep up is dropped
+    def __init__(self, port, host="127.0.0.1"):
+        self.server = socket.create_server((host, port))
+        self.clients = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept_clients, daemon=True).start()
+
+    def accept_clients(self):
+        while True:
+            client, address = self.server.accept()
+            client.settimeout(0.1)
+            with self.lock:
+                self.clients.append(client)
+
+    def write(self, line):
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.sendall(line.encode())
+                except OSError:
+                    client.close()
+                    self.clients.remove(client)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            for client in self.clients:
+                client.close()
+        self.server.close()
+
+
+def detection_record(camera, result):
+    record = {"time": datetime.now().isoformat(timespec="milliseconds"), "camera": camera.camName, "id": camera.camID, "status": camera.status}
+    if result is not None:
+        record["mask_count"] = result.mask_count
+        record["nomask_count"] = result.nomask_count
+        record["detections"] = [{"label": LABELS[cl], "confidence": round(float(score), 4), "box": [int(value) for value in box]}
+                                for cl, score, box in zip(result.classes, result.confidences, result.boxes)]
+    return record
+
+
+def raise_exit(signum, frame):
+    # a service manager stops the runner with SIGTERM, the finally block closing the workers and the cameras still runs
+    raise SystemExit(0)
+
+
+def run(cameras, inference, reconnect, overload, output):
+    # the grabbers wake the loop up when a frame arrives, while nothing does it only polls the inference and the reconnections
+    wake = threading.Event()
+    for camera in cameras:
+        camera.on_frame = wake.set
+    while True:
+        wake.clear()
+        records = []
+        for camera in cameras:
+            if camera.status != "Not Connected":
+                try:
+                    image, detections = camera.next_frame()
+                    if image is not None:
+                        if detections is None:
+                            inference.submit(camera, image, camera.confThreshold, camera.nmsThreshold, camera.detection_input_size(), camera.detection_regions(image))
+                        else:
+                            records.append(detection_record(camera, camera.show_detections(image, detections)))
+                except Exception:
+                    inference.discard(camera)
+                    camera.close_stream()
+                    records.append(detection_record(camera, None))
+        for camera, cam in reconnect.poll([camera for camera in cameras if camera.status == "Not Connected"]):
+            camera.open_stream(cam)
+            records.append(detection_record(camera, None))
+        connected_cameras = [camera for camera in cameras if camera.status != "Not Connected"]
+        for camera, image, detections in inference.poll(len(connected_cameras)):
+            result = camera.detection_done(image, detections)
+            overload.observe(camera.detect_latency)
+            if result is not None:
+                records.append(detection_record(camera, result))
+        if overload.update():
+            apply_level(overload.current(), cameras, inference)
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+        if records:
+            output.flush()
+        else:
+            wake.wait(0.005 if inference.queue_depth() else min([camera.wake_delay(0.1) for camera in connected_cameras], default=0.1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Face Mask Detector without a graphical interface, writing one JSON line per processed frame")
+    parser.add_argument("--camera-list", default=settings.camera_list_path, help="camera list file, one 'name id' pair per line")
+    parser.add_argument("--output", default="-", help="file the JSON lines are appended to, - writes them to the standard output")
+    parser.add_argument("--port", type=int, help="serve the JSON lines on this local TCP port instead")
+    settings.add_arguments(parser, BACKENDS)
+    args = parser.parse_args()
+    settings.apply_arguments(args)
+    settings.create_files()
+    signal.signal(signal.SIGTERM, raise_exit)
+    if args.port is not None:
+        output = SocketOutput(args.port)
+    elif args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "a")
+    loader = ModelLoader()
+    loader.run()
+    if loader.error is not None:
+        sys.exit(1)
+    inference = loader.inference
+    camera_dict = read_camera_list(args.camera_list)
+    cameras = [CameraStream(camera, camera_dict[camera]) for camera in camera_dict]
+    overload = create_overload_controller()
+    metrics_server = MetricsServer(settings.metrics_port, lambda: render_metrics(cameras, inference, get_snapshot_writer(), overload)) if settings.metrics_port else None
+    reconnect = ReconnectScheduler(settings.reconnect_workers, settings.reconnect_interval, settings.reconnect_max_interval)
+    try:
+        run(cameras, inference, reconnect, overload, output)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reconnect.close()
+        for camera in cameras:
+            camera.stop_camera()
+        inference.close()
+        close_snapshot_writer()
+        if metrics_server is not None:
+            metrics_server.close()
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+from detection import DEFAULT_INPUT_SIZE, create_detection_net, BatchInference
+from regions import RegionInference
+from cascade import CascadeInference
+
+
+def inference_worker(config_path, weights_path, backend, shm_name, slot_count, slot_bytes, max_batch_size, num_threads, task_queue, result_queue):
+    cv2.setNumThreads(num_threads)
+    net = create_detection_net(config_path, weights_path, backend)
+    nets = {(config_path, weights_path): net}
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((slot_count, slot_bytes), dtype=np.uint8, buffer=shm.buf)
+    images = []
+    parent = os.getppid()
+    running = True
+    while running:
+        try:
+            tasks = [task_queue.get(timeout=1.0)]
+        except queue.Empty:
+            if os.getppid() != parent:
+                break  # the application died without closing the pool, nothing will read the results
+            continue
+        # everything already queued for this worker goes through the network together
+        while len(tasks) < max_batch_size:
+            try:
+                tasks.append(task_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in tasks:
+            running = False
+            tasks = [task for task in tasks if task is not None]
+        for task in [task for task in tasks if task[0] == "model"]:
+            # ("model", config_path, weights_path) switches the network used from this batch on
+            model, config_path, weights_path = task
+            if (config_path, weights_path) not in nets:
+                nets[config_path, weights_path] = create_detection_net(config_path, weights_path, backend)
+            net = nets[config_path, weights_path]
+        tasks = [task for task in tasks if task[0] != "model"]
+        # frames of different input sizes go through the network in separate batches
+        for input_size in set(task[5] for task in tasks):
+            batch = [task for task in tasks if task[5] == input_size]
+            images = [slots[slot, :int(np.prod(shape))].reshape(shape) for task_id, slot, shape, conf, nms, size in batch]
+            start = time.perf_counter()
+            detections = net.detect_batch(images, [task[3] for task in batch], [task[4] for task in batch], input_size)
+            seconds = (time.perf_counter() - start) / len(batch)
+            for task, (classes, confidences, boxes) in zip(batch, detections):
+                result_queue.put((task[0], classes, confidences, boxes, seconds))
+    del images, slots
+    shm.close()
+
+
+class InferencePool:
+    # runs detection in worker processes that each own a copy of the network, frames are passed through shared memory slots
+    def __init__(self, config_path, weights_path, workers=2, max_batch_size=8, max_frame_size=(1280, 720), backend="cuda"):
+        context = mp.get_context("spawn")
+        if backend == "auto":
+            # benchmark once here instead of in every worker, where the workers would be competing for the same cores
+            backend = create_detection_net(config_path, weights_path, backend).backend
+        self.max_frame_size = max_frame_size
+        self.slot_count = max_batch_size
+        self.slot_bytes = max_frame_size[0] * max_frame_size[1] * 3
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        self.result_queue = context.Queue()
+        self.task_queues = []
+        self.shared_memories = []
+        self.slots = []
+        self.free_slots = []
+        self.processes = []
+        for i in range(workers):
+            shm = shared_memory.SharedMemory(create=True, size=self.slot_count * self.slot_bytes)
+            task_queue = context.Queue()
+            process = context.Process(target=inference_worker, args=(config_path, weights_path, backend, shm.name, self.slot_count, self.slot_bytes,
+                                                                     max_batch_size, num_threads, task_queue, self.result_queue), daemon=True)
+            process.start()
+            self.shared_memories.append(shm)
+            self.slots.append(np.ndarray((self.slot_count, self.slot_bytes), dtype=np.uint8, buffer=shm.buf))
+            self.free_slots.append(list(range(self.slot_count)))
+            self.task_queues.append(task_queue)
+            self.processes.append(process)
+        self.assignment = {}
+        self.tasks = {}
+        self.task_count = 0
+        self.in_flight = set()
+        self.waiting = {}
+        self.forward_seconds = 0.0
+
+    def worker_of(self, key):
+        # new cameras go to the worker with the fewest cameras
+        if key not in self.assignment:
+            loads = [list(self.assignment.values()).count(i) for i in range(len(self.processes))]
+            self.assignment[key] = loads.index(min(loads))
+        return self.assignment[key]
+
+    def submit(self, key, img, confThreshold, nmsThreshold, input_size=None):
+        worker = self.worker_of(key)
+        input_size = input_size or DEFAULT_INPUT_SIZE
+        if key in self.in_flight or not self.free_slots[worker]:
+            self.waiting[key] = (img, confThreshold, nmsThreshold, input_size)
+            return
+        scale = min(1.0, self.max_frame_size[0] / img.shape[1], self.max_frame_size[1] / img.shape[0])
+        frame = img if scale == 1.0 else cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
+        slot = self.free_slots[worker].pop()
+        self.slots[worker][slot, :frame.nbytes].reshape(frame.shape)[...] = frame
+        self.task_count += 1
+        self.tasks[self.task_count] = (key, img, worker, slot, scale)
+        self.in_flight.add(key)
+        self.task_queues[worker].put((self.task_count, slot, frame.shape, confThreshold, nmsThreshold, input_size))
+
+    def discard(self, key):
+        self.waiting.pop(key, None)
+
+    def clear(self):
+        self.waiting = {}
+        self.assignment = {}
+        self.in_flight = set()
+        # results of frames still inside the workers are dropped when they arrive
+        for task_id, (key, img, worker, slot, scale) in self.tasks.items():
+            self.tasks[task_id] = (None, None, worker, slot, scale)
+
+    def queue_depth(self):
+        return len(self.tasks) + len(self.waiting)
+
+    def forward_time(self):
+        # time the workers spent in the network on the results received so far, a batch is shared by its frames
+        return self.forward_seconds
+
+    def set_model(self, config_path, weights_path):
+        for task_queue in self.task_queues:
+            task_queue.put(("model", config_path, weights_path))
+
+    def poll(self, expected=None):
+        results = []
+        while True:
+            try:
+                task_id, classes, confidences, boxes, seconds = self.result_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.forward_seconds += seconds
+            key, img, worker, slot, scale = self.tasks.pop(task_id)
+            self.free_slots[worker].append(slot)
+            if key is None:
+                continue
+            self.in_flight.discard(key)
+            if scale != 1.0:
+                boxes = (boxes / scale).astype(np.int32)
+            results.append((key, img, (classes, confidences, boxes)))
+        for key in [key for key in self.waiting if key not in self.in_flight]:
+            self.submit(key, *self.waiting.pop(key))
+        return results
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.slots = []
+        for shm in self.shared_memories:
+            shm.close()
+            shm.unlink()
+
+
+def create_inference(config_path, weights_path, backend="cuda", workers=0, max_batch_size=8, max_batch_wait=15, fast_model=None, cascade_band=0.15):
+    # returns the network used in this process (None when the workers own it) and the inference stage fed by the cameras,
+    # with a fast_model (config, weights) every frame goes through it first and only the uncertain ones through the given model
+    net, inference = create_stage(config_path, weights_path, backend, workers, max_batch_size, max_batch_wait)
+    if fast_model is None:
+        return net, inference
+    if not os.path.isfile(fast_model[1]):
+        print(f"Cascade disabled, {fast_model[1]} not found", file=sys.stderr)
+        return net, inference
+    return net, CascadeInference(create_stage(*fast_model, backend, workers, max_batch_size, max_batch_wait)[1], inference, fast_model, cascade_band)
+
+
+def create_stage(config_path, weights_path, backend="cuda", workers=0, max_batch_size=8, max_batch_wait=15):
+    if workers > 0:
+        return None, RegionInference(InferencePool(config_path, weights_path, workers, max_batch_size, backend=backend))
+    net = create_detection_net(config_path, weights_path, backend)
+    return net, RegionInference(BatchInference(net, max_batch_size, max_batch_wait))
@@ -0,0 +1,31 @@
+from collections import deque
+import numpy as np
+
+INPUT_SIZES = [320, 416, 512, 608, 640]
+
+
+class AdaptiveInputSize:
+    # picks the smallest network input size at which the smallest faces seen lately are still min_face_height pixels high
+    def __init__(self, min_face_height=24, sizes=INPUT_SIZES, window=100, probe_interval=30):
+        self.min_face_height = min_face_height
+        self.sizes = sorted(sizes)
+        self.face_heights = deque(maxlen=window)  # face heights as a fraction of the frame height
+        self.probe_interval = probe_interval  # every N-th detection runs at the largest size, so smaller faces are not missed for good
+        self.detections = 0
+
+    def next_size(self):
+        self.detections += 1
+        if not self.face_heights or self.detections % self.probe_interval == 0:
+            return self.sizes[-1]
+        smallest = np.percentile(self.face_heights, 10)
+        for size in self.sizes:
+            if smallest * size >= self.min_face_height:
+                return size
+        return self.sizes[-1]
+
+    def update(self, boxes, frame_height):
+        self.face_heights.extend(np.asarray(boxes).reshape(-1, 4)[:, 3] / frame_height)
+
+    def reset(self):
+        self.face_heights.clear()
+        self.detections = 0
@@ -0,0 +1,155 @@
+import sys
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RollingHistogram:
+    # keeps the last `window` durations for the quantiles, the sum and count cover every sample like a Prometheus summary
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.sum += seconds
+
+    def quantiles(self, quantiles=QUANTILES):
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return {q: 0.0 for q in quantiles}
+        return dict(zip(quantiles, np.quantile(samples, quantiles).tolist()))
+
+
+class CameraMetrics:
+    # per-stage timings and counters of one camera, the frame grabber thread writes to it too
+    def __init__(self, fps_window=5):
+        self.stages = {}
+        self.frame_times = deque()
+        self.fps_window = fps_window  # seconds over which the fps is computed
+        self.connects = 0
+        self.disconnects = 0
+        self.connect_failures = 0
+        self.stalls = 0  # streams that stopped delivering frames without reporting an error
+        self.dropped_frames = 0  # frames overwritten by newer ones, of the streams that were already closed
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = RollingHistogram()
+        return self.stages[name]
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(name).observe(time.perf_counter() - start)
+
+    def frame_done(self):
+        now = time.monotonic()
+        self.frame_times.append(now)
+        while self.frame_times and now - self.frame_times[0] > self.fps_window:
+            self.frame_times.popleft()
+
+    def fps(self):
+        now = time.monotonic()
+        recent = [frame_time for frame_time in list(self.frame_times) if now - frame_time <= self.fps_window]
+        return len(recent) / self.fps_window
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_metrics(cameras, inference=None, snapshots=None, overload=None):
+    # Prometheus text format of every camera of the list, of the inference stage, of the photo writer and of the overload controller
+    lines = ["# HELP facemask_stage_seconds Time spent per processing stage.", "# TYPE facemask_stage_seconds summary"]
+    for camera in cameras:
+        for stage, histogram in list(camera.metrics.stages.items()):
+            labels = f'camera="{escape_label(camera.camName)}",stage="{stage}"'
+            for q, value in histogram.quantiles().items():
+                lines.append(f'facemask_stage_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"facemask_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"facemask_stage_seconds_count{{{labels}}} {histogram.count}")
+    camera_metrics = [
+        ("facemask_camera_fps", "gauge", "Detection results per second over the last seconds.", lambda camera: round(camera.metrics.fps(), 3)),
+        ("facemask_camera_connected", "gauge", "1 when the camera stream is open.", lambda camera: int(camera.status != "Not Connected")),
+        ("facemask_camera_dropped_frames_total", "counter", "Frames replaced by a newer one before they were processed.", lambda camera: camera.dropped_frames()),
+        ("facemask_camera_motion_skipped_total", "counter", "Frames whose detection was skipped by the motion gate.", lambda camera: camera.motion_gate.skipped),
+        ("facemask_camera_connects_total", "counter", "Successful connections of the camera stream.", lambda camera: camera.metrics.connects),
+        ("facemask_camera_disconnects_total", "counter", "Losses of the camera stream.", lambda camera: camera.metrics.disconnects),
+        ("facemask_camera_stalls_total", "counter", "Streams closed because no frame arrived before the read timeout.", lambda camera: camera.metrics.stalls),
+        ("facemask_camera_frame_age_seconds", "gauge", "Time since the last frame of the open stream.", lambda camera: camera.frame_age()),
+        ("facemask_camera_source_fps", "gauge", "Frame rate reported by the open stream.", lambda camera: round(camera.source_fps, 3)),
+        ("facemask_camera_frame_allocations_total", "counter", "Frames read into a new array instead of a free pool buffer.", lambda camera: camera.frame_pool.allocations),
+        ("facemask_camera_connect_failures_total", "counter", "Failed attempts to open the camera stream.", lambda camera: camera.metrics.connect_failures),
+    ]
+    for name, metric_type, description, value in camera_metrics:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+        lines += [f'{name}{{camera="{escape_label(camera.camName)}"}} {value(camera)}' for camera in cameras]
+    if inference is not None:
+        lines += ["# HELP facemask_inference_queue_depth Frames waiting for or inside the detector.", "# TYPE facemask_inference_queue_depth gauge",
+                  f"facemask_inference_queue_depth {inference.queue_depth()}"]
+    if hasattr(inference, "escalations"):
+        lines += ["# HELP facemask_cascade_frames_total Frames detected by the fast model of the cascade.", "# TYPE facemask_cascade_frames_total counter",
+                  f"facemask_cascade_frames_total {inference.frame_count}",
+                  "# HELP facemask_cascade_escalations_total Frames sent on to the accurate model, by reason.", "# TYPE facemask_cascade_escalations_total counter"]
+        lines += [f'facemask_cascade_escalations_total{{reason="{reason}"}} {count}' for reason, count in inference.escalations.items()]
+        lines += ["# HELP facemask_cascade_saved_seconds Detection time saved compared with running the accurate model on every frame.",
+                  "# TYPE facemask_cascade_saved_seconds gauge", f"facemask_cascade_saved_seconds {inference.saved_seconds():.3f}"]
+        lines += ["# HELP facemask_cascade_stage_seconds Time from the submission of a frame to the result of a cascade stage.", "# TYPE facemask_cascade_stage_seconds summary"]
+        for stage, histogram in [("fast", inference.fast_seconds), ("accurate", inference.accurate_seconds)]:
+            lines.append(f'facemask_cascade_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+            lines.append(f'facemask_cascade_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+    if snapshots is not None:
+        snapshot_metrics = [
+            ("facemask_photos_pending", "gauge", "Photos waiting to be written.", snapshots.pending),
+            ("facemask_photos_dropped_total", "counter", "Photos discarded because the photo queue was full.", snapshots.dropped),
+            ("facemask_photos_written_total", "counter", "Photos written to the disk.", snapshots.written),
+            ("facemask_photos_failed_total", "counter", "Photos that could not be written.", snapshots.failed),
+        ]
+        for name, metric_type, description, value in snapshot_metrics:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+    if overload is not None:
+        lines += ["# HELP facemask_overload_level Degradation level of the overload controller, 0 is normal processing.", "# TYPE facemask_overload_level gauge",
+                  f'facemask_overload_level{{name="{escape_label(overload.current().name)}"}} {overload.level}']
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # serves the output of collect() on http://127.0.0.1:<port>/metrics from a background thread
+    def __init__(self, port, collect, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = collect().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics served on http://{host}:{self.server.server_address[1]}/metrics", file=sys.stderr)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import threading
+import cv2
+import numpy as np
+
+import settings
+from detection import DEFAULT_INPUT_SIZE, DetectionNet, available_backends, select_backend
+from inference_pool import create_inference
+from cascade import CascadeInference
+
+
+def cache_key(config_path, weights_path):
+    # a model file replaced or an OpenCV upgrade invalidates what was measured with the previous one
+    stat = os.stat(weights_path)
+    return f"{os.path.abspath(config_path)}|{os.path.abspath(weights_path)}|{stat.st_size}|{int(stat.st_mtime)}|{cv2.__version__}"
+
+
+def read_model_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_model_cache(cache_path, cache):
+    with open(cache_path, "w") as cache_file:
+        json.dump(cache, cache_file, indent=2)
+
+
+def resolve_backend(config_path, weights_path, backend, entry):
+    # "auto" benchmarks every backend once, later starts reuse the winner while it is still available
+    if backend != "auto":
+        return backend
+    if entry.get("backend") in available_backends():
+        print(f"Using detection backend {entry['backend']} (benchmarked at an earlier start)", file=sys.stderr)
+        return entry["backend"]
+    entry["backend"] = select_backend(DetectionNet(config_path, weights_path, DEFAULT_INPUT_SIZE), available_backends())
+    return entry["backend"]
+
+
+def warm_up(inference, input_size, frames=1, timeout=300):
+    # the first forward pass allocates the layers and tunes the backend, a dummy frame per worker pays for it before the cameras start
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+    deadline = time.monotonic() + timeout
+    stages = [inference.fast, inference.accurate] if isinstance(inference, CascadeInference) else [inference]
+    for stage in stages:
+        run_frames(stage, frame, input_size, frames, deadline)
+    if isinstance(inference, CascadeInference):
+        # a frame through the warm accurate model is what the cascade saves on every frame it does not escalate
+        start = inference.accurate.forward_time()
+        run_frames(inference.accurate, frame, input_size, 1, deadline)
+        inference.accurate_frame_seconds = inference.accurate.forward_time() - start
+
+
+def run_frames(stage, frame, input_size, frames, deadline):
+    for i in range(frames):
+        stage.submit(("warm-up", i), frame, 0.5, 0.5, input_size)
+    done = 0
+    while done < frames and time.monotonic() < deadline:
+        done += len(stage.poll(frames - done))
+        time.sleep(0.005)
+    stage.clear()
+
+
+class ModelLoader(threading.Thread):
+    # loads and warms up the inference stage in the background, the progress (0 to 1) and message can be read while it runs
+    def __init__(self, cache_path=None):
+        super().__init__(daemon=True)
+        self.cache_path = cache_path or settings.model_cache_path
+        self.progress = 0.0
+        self.message = "Loading the detection model"
+        self.net = None
+        self.inference = None
+        self.error = None
+        self.timings = {}
+
+    def set_progress(self, progress, message):
+        self.progress = progress
+        self.message = message
+
+    def run(self):
+        try:
+            self.load()
+        except Exception as error:
+            self.error = error
+            self.message = f"Could not load the detection model: {error}"
+            print(self.message, file=sys.stderr)
+
+    def load(self):
+        start = time.perf_counter()
+        cache = read_model_cache(self.cache_path)
+        key = cache_key(settings.configPath, settings.weightsPath)
+        entry = cache.setdefault(key, {})
+        warm = "cold_start_s" in entry
+        self.set_progress(0.05, "Selecting the detection backend")
+        backend = resolve_backend(settings.configPath, settings.weightsPath, settings.detection_backend, entry)
+        backend_time = time.perf_counter()
+        self.set_progress(0.2, "Loading the detection model")
+        self.net, self.inference = create_inference(settings.configPath, settings.weightsPath, backend, settings.inference_workers,
+                                                    settings.max_batch_size, settings.max_batch_wait,
+                                                    (settings.tiny_configPath, settings.tiny_weightsPath) if settings.cascade else None, settings.cascade_band)
+        load_time = time.perf_counter()
+        self.set_progress(0.6, "Warming up the detection model")
+        input_size = settings.input_size if str(settings.input_size).isdigit() else DEFAULT_INPUT_SIZE[0]
+        warm_up(self.inference, (int(input_size), int(input_size)), max(1, settings.inference_workers))
+        end = time.perf_counter()
+        self.timings = {"backend_s": round(backend_time - start, 3), "load_s": round(load_time - backend_time, 3),
+                        "warmup_s": round(end - load_time, 3), "total_s": round(end - start, 3), "warm": warm}
+        entry["warm_start_s" if warm else "cold_start_s"] = self.timings["total_s"]
+        write_model_cache(self.cache_path, cache)
+        message = f"Detection model ready in {self.timings['total_s']:0.1f} s ({'warm' if warm else 'cold'} start"
+        if warm:
+            message += f", cold start took {entry['cold_start_s']:0.1f} s"
+        self.set_progress(1.0, message + ")")
+        print(f"{self.message}: backend {self.timings['backend_s']:0.1f} s, load {self.timings['load_s']:0.1f} s, warm-up {self.timings['warmup_s']:0.1f} s", file=sys.stderr)
@@ -0,0 +1,38 @@
+import time
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    # compares a downscaled copy of every frame with the last frame that was analysed
+    def __init__(self, threshold=0.01, refresh_interval=5, pixel_threshold=25, size=(64, 36)):
+        self.threshold = threshold  # fraction of the downscaled frame that has to change, 0 disables the gate
+        self.refresh_interval = refresh_interval  # seconds after which a detection is forced even on a static scene
+        self.pixel_threshold = pixel_threshold
+        self.size = size
+        self.reference = None
+        self.last_refresh = 0
+        self.frame_count = 0
+        self.skipped = 0
+
+    def changed(self, img):
+        self.frame_count += 1
+        if self.threshold <= 0:
+            return True
+        small = cv2.cvtColor(cv2.resize(img, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        small = cv2.GaussianBlur(small, (3, 3), 0)
+        now = time.monotonic()
+        if self.reference is None or now - self.last_refresh >= self.refresh_interval:
+            moved = True
+        else:
+            diff = cv2.absdiff(small, self.reference)
+            moved = np.count_nonzero(diff > self.pixel_threshold) > self.threshold * diff.size
+        if moved:
+            self.reference = small
+            self.last_refresh = now
+        else:
+            self.skipped += 1
+        return moved
+
+    def reset(self):
+        self.reference = None
@@ -0,0 +1,157 @@
+import os
+import csv
+import time
+import queue
+import argparse
+import threading
+import multiprocessing as mp
+from pathlib import Path
+import cv2
+import numpy as np
+
+import settings
+from detection import BACKENDS, create_detection_net, summarize_detections
+from camera_stream import needs_photo
+from snapshot_writer import get_snapshot_writer
+
+OUTPUT_FORMATS = ["csv", "npz", "parquet"]
+PHOTO_POLICY = "block"  # a video waits for its photos instead of losing them, unlike a live camera
+
+
+class VideoReader(threading.Thread):
+    # decodes a video file as fast as possible on its own thread, so decoding overlaps with the detection
+    def __init__(self, path, frame_step=1, queue_size=64):
+        super().__init__(daemon=True)
+        self.cam = cv2.VideoCapture(path)
+        self.fps = self.cam.get(cv2.CAP_PROP_FPS) or 30
+        self.frame_step = frame_step
+        self.frames = queue.Queue(queue_size)
+
+    def run(self):
+        index = 0
+        while True:
+            if index % self.frame_step == 0:
+                ret, frame = self.cam.read()
+                if not ret:
+                    break
+                self.frames.put((index, frame))
+            elif not self.cam.grab():
+                break
+            index += 1
+        self.cam.release()
+        self.frames.put(None)
+
+
+def next_batch(frames, batch_size):
+    # waits for the first frame, then takes whatever else is already decoded, None marks the end of the video
+    batch = []
+    item = frames.get()
+    while item is not None:
+        batch.append(item)
+        if len(batch) == batch_size:
+            break
+        try:
+            item = frames.get_nowait()
+        except queue.Empty:
+            break
+    return batch, item is None
+
+
+def save_snapshot(image, name, status, seconds):
+    position = time.strftime("%H.%M.%S", time.gmtime(seconds)) + f".{int(seconds * 1000) % 1000:03d}"
+    get_snapshot_writer(PHOTO_POLICY).write(os.path.join(settings.photo_path, name, status), name + "_" + position, image)
+
+
+def write_results(rows, output_path, output_format):
+    if output_format == "csv":
+        with open(output_path, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(list(rows))
+            writer.writerows(zip(*rows.values()))
+    elif output_format == "npz":
+        np.savez_compressed(output_path, **{column: np.asarray(values) for column, values in rows.items()})
+    else:
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.table(rows), output_path)
+
+
+def process_video(path, net, output_dir, output_format, batch_size=8, frame_step=1, confThreshold=0.5, nmsThreshold=0.5):
+    name = Path(path).stem
+    reader = VideoReader(path, frame_step)
+    reader.start()
+    rows = {"frame": [], "time": [], "mask_count": [], "nomask_count": [], "status": []}
+    prev_status = "Safe"
+    start = time.perf_counter()
+    done = False
+    while not done:
+        batch, done = next_batch(reader.frames, batch_size)
+        if not batch:
+            continue
+        detections = net.detect_batch([frame for index, frame in batch], [confThreshold] * len(batch), [nmsThreshold] * len(batch))
+        for (index, frame), detection in zip(batch, detections):
+            result = summarize_detections(*detection)
+            rows["frame"].append(index)
+            rows["time"].append(round(index / reader.fps, 3))
+            rows["mask_count"].append(result.mask_count)
+            rows["nomask_count"].append(result.nomask_count)
+            rows["status"].append(result.status)
+            if needs_photo(prev_status, result.status):
+                save_snapshot(frame, name, result.status, index / reader.fps)
+            prev_status = result.status
+    get_snapshot_writer(PHOTO_POLICY).flush()
+    elapsed = time.perf_counter() - start
+    write_results(rows, os.path.join(output_dir, name + "." + output_format), output_format)
+    return path, len(rows["frame"]), elapsed
+
+
+def init_worker(config_path, weights_path, backend, num_threads):
+    global worker_net
+    cv2.setNumThreads(num_threads)
+    worker_net = create_detection_net(config_path, weights_path, backend)
+
+
+def process_video_in_worker(job):
+    return process_video(job[0], worker_net, *job[1:])
+
+
+def process_videos(paths, output_dir, output_format="csv", jobs=1, batch_size=8, frame_step=1, backend="cuda", config_path=settings.configPath, weights_path=settings.weightsPath):
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    job_args = [(path, output_dir, output_format, batch_size, frame_step) for path in paths]
+    if jobs <= 1:
+        net = create_detection_net(config_path, weights_path, backend)
+        return [process_video(job[0], net, *job[1:]) for job in job_args]
+    if backend == "auto":
+        backend = create_detection_net(config_path, weights_path, backend).backend
+    num_threads = max(1, (os.cpu_count() or 1) // jobs)
+    with mp.get_context("spawn").Pool(jobs, init_worker, (config_path, weights_path, backend, num_threads)) as pool:
+        return list(pool.imap_unordered(process_video_in_worker, job_args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the face mask detection on video files as fast as possible and write the per-frame counts and status")
+    parser.add_argument("videos", nargs="+", help="video files to process")
+    parser.add_argument("--output-dir", default="results", help="directory of the per-video result files")
+    parser.add_argument("--format", default="csv", choices=OUTPUT_FORMATS, help="format of the result files (parquet needs pyarrow)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of videos processed at the same time, each in its own process")
+    parser.add_argument("--frame-step", type=int, default=1, help="only run the detection on every N-th frame")
+    settings.add_model_arguments(parser, BACKENDS)
+    args = parser.parse_args()
+    # the results and photos of a video are named after its file name
+    names = [Path(path).stem for path in args.videos]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        parser.error("videos with the same file name would overwrite each other's results and photos: " + ", ".join(duplicates))
+    if args.format == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("the parquet format needs pyarrow (pip install pyarrow)")
+    start = time.perf_counter()
+    results = process_videos(args.videos, args.output_dir, args.format, args.jobs, args.max_batch_size, args.frame_step, args.backend, args.config, args.weights)
+    total_frames = 0
+    for path, frames, elapsed in results:
+        total_frames += frames
+        print(f"{path}: {frames} frames in {elapsed:0.1f} s ({frames / max(elapsed, 1e-6):0.1f} frames/s)")
+    elapsed = time.perf_counter() - start
+    print(f"Total: {total_frames} frames in {elapsed:0.1f} s ({total_frames / max(elapsed, 1e-6):0.1f} frames/s)")
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+
+import settings
+
+OverloadLevel = namedtuple("OverloadLevel", ["name", "max_fps", "max_input_size", "tiny"])
+LEVELS = [
+    OverloadLevel("normal", 0, None, False),
+    OverloadLevel("reduced fps", 10, None, False),
+    OverloadLevel("input size 416", 10, 416, False),
+    OverloadLevel("input size 320", 10, 320, False),
+    OverloadLevel("tiny model", 10, 320, True),
+]
+
+
+class OverloadController:
+    # compares the detection latency with a budget and steps the processing down or back up one level at a time
+    def __init__(self, budget, levels=LEVELS, window=2.0, recover_ratio=0.6, recover_windows=3):
+        self.budget = budget / 1000  # ms, 0 disables the controller
+        self.levels = levels
+        self.window = window  # seconds of latencies compared with the budget at once
+        self.recover_ratio = recover_ratio  # a level is only left upwards while the latency stays under this fraction of the budget
+        self.recover_windows = recover_windows  # ... for this many windows in a row
+        self.level = 0
+        self.latencies = []
+        self.window_start = time.monotonic()
+        self.calm_windows = 0
+
+    def current(self):
+        return self.levels[self.level]
+
+    def observe(self, latency):
+        if self.budget > 0:
+            self.latencies.append(latency)
+
+    def update(self):
+        # returns True when the level changed
+        now = time.monotonic()
+        if self.budget <= 0 or now - self.window_start < self.window or not self.latencies:
+            return False
+        latency = np.percentile(self.latencies, 90)
+        self.latencies = []
+        self.window_start = now
+        if latency > self.budget:
+            self.calm_windows = 0
+            if self.level < len(self.levels) - 1:
+                self.level += 1
+                return True
+        elif latency < self.budget * self.recover_ratio:
+            self.calm_windows += 1
+            if self.calm_windows >= self.recover_windows and self.level > 0:
+                self.calm_windows = 0
+                self.level -= 1
+                return True
+        else:
+            self.calm_windows = 0
+        return False
+
+
+def create_overload_controller():
+    levels = LEVELS
+    if not os.path.isfile(settings.tiny_weightsPath):
+        levels = [level for level in LEVELS if not level.tiny]
+    return OverloadController(settings.overload_budget, levels)
+
+
+def apply_level(level, cameras, inference):
+    for camera in cameras:
+        camera.max_fps = level.max_fps
+        camera.max_input_size = level.max_input_size
+    if level.tiny:
+        inference.set_model(settings.tiny_configPath, settings.tiny_weightsPath)
+    else:
+        inference.set_model(settings.configPath, settings.weightsPath)
+    print(f"Overload level {level.name}", file=sys.stderr)
@@ -0,0 +1,59 @@
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+
+def release_stream(future):
+    if not future.cancelled() and future.result() is not None:
+        future.result().release()
+
+
+class ReconnectScheduler:
+    # opens the streams of the disconnected cameras on background threads, waiting longer after every failed attempt
+    def __init__(self, workers=4, interval=1.0, max_interval=30.0, jitter=0.2):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="reconnect")
+        self.interval = interval  # wait after the first failure, doubled after every other one
+        self.max_interval = max_interval
+        self.jitter = jitter  # random fraction added or removed, so cameras lost together do not retry together
+        self.failures = {}
+        self.next_attempt = {}
+        self.attempts = {}
+
+    def delay(self, failures):
+        delay = min(self.max_interval, self.interval * 2 ** (failures - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def poll(self, cameras):
+        # starts the attempts that are due for the given disconnected cameras and returns the (camera, stream) pairs that opened
+        now = time.monotonic()
+        connected = []
+        for camera, attempt in list(self.attempts.items()):
+            if not attempt.done():
+                continue
+            del self.attempts[camera]
+            cam = attempt.result()
+            if cam is not None:
+                self.failures.pop(camera, None)
+                self.next_attempt.pop(camera, None)
+                connected.append((camera, cam))
+            else:
+                self.failures[camera] = self.failures.get(camera, 0) + 1
+                camera.metrics.connect_failures += 1
+                self.next_attempt[camera] = now + self.delay(self.failures[camera])
+        opened = [camera for camera, cam in connected]
+        for camera in cameras:
+            if camera not in self.attempts and camera not in opened and now >= self.next_attempt.get(camera, 0):
+                self.attempts[camera] = self.executor.submit(camera.connect_stream)
+        return connected
+
+    def clear(self):
+        # attempts still running release their stream when they finish
+        for attempt in self.attempts.values():
+            attempt.add_done_callback(release_stream)
+        self.attempts = {}
+        self.failures = {}
+        self.next_attempt = {}
+
+    def close(self):
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
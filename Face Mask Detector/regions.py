@@ -0,0 +1,184 @@
+import math
+from functools import lru_cache
+import cv2
+import numpy as np
+
+
+class Region:
+    # a rectangle or polygon of a camera frame, only its bounding rectangle goes through the detector
+    keep_density = True  # the input size shrinks with the region, so it is seen at the pixel density of the whole frame
+
+    def __init__(self, points):
+        self.points = np.array(points, dtype=np.int32).reshape(-1, 2)
+        left, top = self.points.min(axis=0)
+        right, bottom = self.points.max(axis=0)
+        self.rect = (int(left), int(top), int(right - left), int(bottom - top))
+        self.is_rect = len(self.points) == 4 and cv2.contourArea(self.points) == self.rect[2] * self.rect[3]
+
+    def crop(self, image):
+        # returns a view of the image and its offset, clipped to the frame
+        x, y, width, height = self.rect
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(image.shape[1], x + width), min(image.shape[0], y + height)
+        return image[top:bottom, left:right], (left, top)
+
+    def contains(self, boxes):
+        # True for the boxes whose centre lies inside the region
+        if self.is_rect:
+            return np.ones(len(boxes), dtype=bool)
+        centers = boxes[:, :2] + boxes[:, 2:] / 2
+        return np.array([cv2.pointPolygonTest(self.points, (float(x), float(y)), False) >= 0 for x, y in centers], dtype=bool)
+
+
+class Tile(Region):
+    # a tile of a frame too large for a single detection, seen at the full input size of the camera
+    keep_density = False
+
+    def __init__(self, left, top, width, height, inner_edges):
+        super().__init__([(left, top), (left + width, top), (left + width, top + height), (left, top + height)])
+        self.inner_edges = inner_edges  # (left, top, right, bottom) True where the tile overlaps a neighbour
+
+    def contains(self, boxes):
+        # a face cut by an edge shared with a neighbour is left to the neighbour, which sees it whole within the overlap
+        left, top, width, height = self.rect
+        inner_left, inner_top, inner_right, inner_bottom = self.inner_edges
+        cut = np.zeros(len(boxes), dtype=bool)
+        if inner_left:
+            cut |= boxes[:, 0] <= left + 1
+        if inner_top:
+            cut |= boxes[:, 1] <= top + 1
+        if inner_right:
+            cut |= boxes[:, 0] + boxes[:, 2] >= left + width - 1
+        if inner_bottom:
+            cut |= boxes[:, 1] + boxes[:, 3] >= top + height - 1
+        return ~cut
+
+
+@lru_cache(maxsize=32)
+def tile_layout(frame_width, frame_height, columns, rows, overlap=0.2):
+    # columns x rows tiles covering the frame, neighbours overlapping by a fraction of a tile, computed once per resolution
+    tile_width = math.ceil(frame_width / (columns - (columns - 1) * overlap))
+    tile_height = math.ceil(frame_height / (rows - (rows - 1) * overlap))
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            left = min(int(column * tile_width * (1 - overlap)), frame_width - tile_width)
+            top = min(int(row * tile_height * (1 - overlap)), frame_height - tile_height)
+            tiles.append(Tile(left, top, tile_width, tile_height, (column > 0, row > 0, column < columns - 1, row < rows - 1)))
+    return tuple(tiles)
+
+
+def parse_tiles(text):
+    # "COLUMNSxROWS", None when the camera is not tiled
+    if "x" not in text:
+        return None
+    columns, rows = [int(value) for value in text.lower().split("x")]
+    return (columns, rows) if columns * rows > 1 else None
+
+
+def parse_regions(text):
+    # "x,y,w,h" rectangles or "x1,y1 x2,y2 x3,y3 ..." polygons, separated by ";"
+    regions = []
+    for part in text.split(";"):
+        fields = part.split()
+        if len(fields) == 1 and fields[0].count(",") == 3:
+            x, y, width, height = [int(value) for value in fields[0].split(",")]
+            regions.append(Region([(x, y), (x + width, y), (x + width, y + height), (x, y + height)]))
+        elif len(fields) >= 3:
+            regions.append(Region([[int(value) for value in field.split(",")] for field in fields]))
+    return regions
+
+
+def crop_input_size(input_size, crop_shape, frame_shape):
+    # keeps the pixel density the whole frame would get, so a small crop also gets a small (multiple of 32) input
+    width = min(input_size[0], max(32, math.ceil(input_size[0] * crop_shape[1] / frame_shape[1] / 32) * 32))
+    height = min(input_size[1], max(32, math.ceil(input_size[1] * crop_shape[0] / frame_shape[0] / 32) * 32))
+    return width, height
+
+
+def merge_detections(regions, offsets, detections, nmsThreshold):
+    classes, confidences, boxes = [], [], []
+    for region, (left, top), (region_classes, region_confidences, region_boxes) in zip(regions, offsets, detections):
+        region_boxes = np.asarray(region_boxes, dtype=np.int32).reshape(-1, 4) + np.array([left, top, 0, 0], dtype=np.int32)
+        inside = region.contains(region_boxes)
+        classes.append(np.asarray(region_classes, dtype=np.int32).reshape(-1)[inside])
+        confidences.append(np.asarray(region_confidences, dtype=np.float32).reshape(-1)[inside])
+        boxes.append(region_boxes[inside])
+    classes, confidences, boxes = np.concatenate(classes), np.concatenate(confidences), np.concatenate(boxes)
+    if len(regions) > 1 and len(boxes):
+        # a face in the overlap of two regions or tiles is detected twice
+        indices = np.array(cv2.dnn.NMSBoxesBatched(boxes.tolist(), confidences.tolist(), classes.tolist(), 0, nmsThreshold), dtype=np.int64).reshape(-1)
+        classes, confidences, boxes = classes[indices], confidences[indices], boxes[indices]
+    return classes, confidences, boxes
+
+
+class RegionInference:
+    # wraps an inference stage: the regions of a frame are detected as separate images and their boxes mapped back to the frame
+    def __init__(self, inference):
+        self.inference = inference
+        self.frames = {}
+        self.waiting = {}
+
+    def submit(self, key, img, confThreshold, nmsThreshold, input_size=None, regions=None):
+        if not regions:
+            self.inference.submit((key, None), img, confThreshold, nmsThreshold, input_size)
+            return
+        if key in self.frames:
+            # the regions of a frame are detected together, a newer frame waits for them
+            self.waiting[key] = (img, confThreshold, nmsThreshold, input_size, regions)
+            return
+        crops = [(region, *region.crop(img)) for region in regions]
+        crops = [(region, crop, offset) for region, crop, offset in crops if crop.size]
+        if not crops:
+            # none of the regions lies inside this frame
+            self.inference.submit((key, None), img, confThreshold, nmsThreshold, input_size)
+            return
+        self.frames[key] = (img, nmsThreshold, [region for region, crop, offset in crops], [offset for region, crop, offset in crops], {})
+        for i, (region, crop, offset) in enumerate(crops):
+            size = crop_input_size(input_size, crop.shape, img.shape) if input_size and region.keep_density else input_size
+            self.inference.submit((key, i), crop, confThreshold, nmsThreshold, size)
+
+    def discard(self, key):
+        self.inference.discard((key, None))
+        if key in self.frames:
+            for i in range(len(self.frames[key][2])):
+                self.inference.discard((key, i))
+        self.frames.pop(key, None)
+        self.waiting.pop(key, None)
+
+    def clear(self):
+        self.inference.clear()
+        self.frames = {}
+        self.waiting = {}
+
+    def close(self):
+        self.inference.close()
+
+    def queue_depth(self):
+        return self.inference.queue_depth()
+
+    def forward_time(self):
+        return self.inference.forward_time()
+
+    def set_model(self, config_path, weights_path):
+        self.inference.set_model(config_path, weights_path)
+
+    def poll(self, expected=None):
+        if expected is not None:
+            expected += sum(len(frame[2]) - 1 for frame in self.frames.values())
+        results = []
+        for (key, i), img, detections in self.inference.poll(expected):
+            if i is None:
+                results.append((key, img, detections))
+                continue
+            if key not in self.frames:
+                continue
+            frame, nmsThreshold, regions, offsets, region_detections = self.frames[key]
+            region_detections[i] = detections
+            if len(region_detections) == len(regions):
+                del self.frames[key]
+                detections = merge_detections(regions, offsets, [region_detections[i] for i in range(len(regions))], nmsThreshold)
+                results.append((key, frame, detections))
+                if key in self.waiting:
+                    self.submit(key, *self.waiting.pop(key))
+        return results
@@ -0,0 +1,125 @@
+from pathlib import Path
+
+weightsPath = "yolo_utils/yolov4_face_mask.weights"
+configPath = "yolo_utils/yolov4-mask.cfg"
+# weightsPath = "yolo_utils/yolov4-tiny-mask.weights"
+# configPath = "yolo_utils/yolov4-tiny-mask.cfg"
+# weightsPath = "yolo_utils/yolov4_face_mask.onnx"  # export of configPath by export_onnx.py, the .int8.onnx one runs fastest with the onnxruntime backend
+tiny_weightsPath = "yolo_utils/yolov4-tiny-mask.weights"  # lighter network used by the overload controller at its last level
+tiny_configPath = "yolo_utils/yolov4-tiny-mask.cfg"
+photo_path = "photos"
+camera_list_path = "resources/camera_list.txt"
+connect_log_path = "resources/connect_history.log"
+camera_input_size_path = "resources/camera_input_size.txt"  # optional "name size" lines overriding input_size for some cameras
+camera_roi_path = "resources/camera_roi.txt"  # optional "name regions" lines limiting the detection of a camera to rectangles or polygons
+camera_tiles_path = "resources/camera_tiles.txt"  # optional "name COLUMNSxROWS" lines overriding tiles for some cameras
+camera_pacing_path = "resources/camera_pacing.txt"  # optional "name pacing" lines overriding pacing for some cameras
+max_batch_size = 8  # maximum number of camera frames sent through the network in a single forward pass
+max_batch_wait = 15  # maximum time (ms) a frame waits for the other cameras before its batch is run
+input_size = 640  # network input size (multiple of 32) of the cameras, "auto" picks the smallest size that keeps the faces above min_face_height
+min_face_height = 24  # smallest face height (pixels of the network input) the automatic input size keeps
+tiles = ""  # "COLUMNSxROWS" splits the frames of the cameras without regions into tiles detected at the full input size, "" disables it
+tile_overlap = 0.2  # fraction of a tile shared with its neighbours, faces wider than the overlap can be cut between two tiles
+detection_backend = "cuda"  # one of the detection.BACKENDS names, or "auto" to benchmark the available backends at startup and use the fastest
+motion_threshold = 0.01  # fraction of a frame that has to change before it is sent to the detector again, 0 runs the detector on every frame
+motion_refresh = 5  # time (s) after which a detection is forced even if nothing moved
+detect_interval = 1  # run the detector every N frames and track its boxes in between, 1 runs it on every frame
+tracker_min_confidence = 0.5  # the detector also runs as soon as the fraction of reliably tracked points of a box drops below this
+capture_size = (1280, 720)  # resolution asked from the cameras of the system, for the display and the photos
+scale_frames = True  # frames larger than the detector needs are scaled down on the grabber thread, the display and the photos keep the full frame
+frame_buffers = 6  # preallocated frame buffers per camera, a camera holding more frames at once reads into new arrays
+pacing = "realtime"  # "realtime" plays files at their fps and drops the frames the detection cannot keep up with, "every_frame" detects every frame at most at the source fps, "fast" detects every frame as fast as possible
+inference_workers = 0  # number of inference worker processes, 0 runs the detection inside the application process
+cascade = False  # run the tiny model on every frame and the full model only on the frames it is unsure about
+cascade_band = 0.15  # tiny model detections within this distance of the confidence threshold send the frame to the full model
+photo_format = "jpg"  # jpg, png or webp
+photo_quality = 95  # JPEG/WebP quality (0-100) of the photos
+photo_writers = 2  # threads encoding and writing the photos
+photo_queue_size = 32  # photos waiting to be written before the policy applies
+photo_policy = "drop"  # "drop" discards new photos while the queue is full, "block" waits for the disk
+reconnect_interval = 1.0  # time (s) before a disconnected camera is tried again, doubled after every failed attempt
+reconnect_max_interval = 30.0  # longest time (s) between two attempts
+reconnect_workers = 4  # cameras that can be connecting at the same time
+open_timeout = 10.0  # time (s) a network stream has to answer when it is opened
+read_timeout = 5.0  # a stream without a new frame for this long (s) is closed and reconnected, 0 waits forever
+overload_budget = 0  # detection latency (ms) above which the fps, the input size and then the model are reduced, 0 disables it
+model_cache_path = "resources/model_cache.json"  # backend chosen by --backend auto and startup times per model, so later starts skip the benchmark
+metrics_port = 0  # local port of the Prometheus metrics endpoint, 0 disables it
+
+photo_dir = Path(photo_path)
+cam_list_filename = Path(camera_list_path)
+connect_log_filename = Path(connect_log_path)
+
+
+def create_files():
+    # the files of the camera applications, only their entry points create them so the other tools can be run from anywhere
+    photo_dir.mkdir(parents=True, exist_ok=True)
+    cam_list_filename.touch(exist_ok=True)
+    connect_log_filename.touch(exist_ok=True)
+
+
+def add_model_arguments(parser, backends):
+    # the network options, shared by the tools that do not take the camera options
+    parser.add_argument("--config", default=configPath, help="Darknet config of the network, also needed to decode its ONNX export")
+    parser.add_argument("--weights", default=weightsPath, help="Darknet weights of the network, or its ONNX export by export_onnx.py")
+    parser.add_argument("--backend", default=detection_backend, choices=list(backends) + ["onnxruntime", "auto"], help="DNN backend/target used for the detection, auto benchmarks the available ones, onnxruntime runs the ONNX exports")
+    parser.add_argument("--max-batch-size", type=int, default=max_batch_size, help="maximum number of frames in a single forward pass")
+
+
+def add_arguments(parser, backends):
+    add_model_arguments(parser, backends)
+    parser.add_argument("--input-size", default=input_size, help="network input size (multiple of 32) of the cameras, or auto to adapt it to the size of the faces")
+    parser.add_argument("--min-face-height", type=int, default=min_face_height, help="smallest face height (pixels at the network input) kept by --input-size auto")
+    parser.add_argument("--tiles", default=tiles, help="detect every frame as COLUMNSxROWS overlapping tiles, for high resolution cameras with small faces")
+    parser.add_argument("--tile-overlap", type=float, default=tile_overlap, help="fraction of a tile shared with its neighbours")
+    parser.add_argument("--pacing", default=pacing, choices=["realtime", "every_frame", "fast"], help="drop frames to keep up with the clock, detect every frame at most at the source fps, or every frame as fast as possible")
+    parser.add_argument("--motion-threshold", type=float, default=motion_threshold, help="fraction of a frame that has to change before the detector runs again (0 disables the motion gate)")
+    parser.add_argument("--motion-refresh", type=float, default=motion_refresh, help="time (s) after which a detection is forced on a static scene")
+    parser.add_argument("--detect-interval", type=int, default=detect_interval, help="run the detector every N frames and track the faces in between (1 disables the tracker)")
+    parser.add_argument("--tracker-confidence", type=float, default=tracker_min_confidence, help="tracking confidence under which the detector runs before its interval is over")
+    parser.add_argument("--workers", type=int, default=inference_workers, help="number of inference worker processes (0 runs the detection inside the application process)")
+    parser.add_argument("--cascade", action="store_true", default=cascade, help="detect with the tiny model first and confirm uncertain frames with the full model")
+    parser.add_argument("--cascade-band", type=float, default=cascade_band, help="confidence distance from the threshold within which the tiny model is confirmed")
+    parser.add_argument("--max-batch-wait", type=int, default=max_batch_wait, help="maximum time (ms) a frame waits for a batch to fill")
+    parser.add_argument("--photo-format", default=photo_format, choices=["jpg", "png", "webp"], help="image format of the photos")
+    parser.add_argument("--photo-quality", type=int, default=photo_quality, help="JPEG/WebP quality (0-100) of the photos")
+    parser.add_argument("--photo-queue-size", type=int, default=photo_queue_size, help="number of photos waiting to be written before --photo-policy applies")
+    parser.add_argument("--photo-policy", default=photo_policy, choices=["drop", "block"], help="drop new photos or wait when the photo queue is full")
+    parser.add_argument("--reconnect-interval", type=float, default=reconnect_interval, help="time (s) before a disconnected camera is tried again, doubled after every failure")
+    parser.add_argument("--reconnect-max-interval", type=float, default=reconnect_max_interval, help="longest time (s) between two connection attempts of a camera")
+    parser.add_argument("--open-timeout", type=float, default=open_timeout, help="time (s) a network stream has to answer when it is opened")
+    parser.add_argument("--read-timeout", type=float, default=read_timeout, help="close and reconnect a stream that delivered no frame for this long (s), 0 waits forever")
+    parser.add_argument("--overload-budget", type=float, default=overload_budget, help="detection latency (ms) above which the processing is degraded step by step (0 disables it)")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port, help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics (0 disables them)")
+
+
+def apply_arguments(args):
+    global configPath, weightsPath, input_size, min_face_height, tiles, tile_overlap, pacing, detection_backend, motion_threshold, motion_refresh, detect_interval, tracker_min_confidence, inference_workers, cascade, cascade_band, max_batch_size, max_batch_wait, metrics_port
+    global photo_format, photo_quality, photo_queue_size, photo_policy, reconnect_interval, reconnect_max_interval, open_timeout, read_timeout, overload_budget
+    configPath = args.config
+    weightsPath = args.weights
+    input_size = args.input_size
+    min_face_height = args.min_face_height
+    tiles = args.tiles
+    tile_overlap = args.tile_overlap
+    pacing = args.pacing
+    detection_backend = args.backend
+    motion_threshold = args.motion_threshold
+    motion_refresh = args.motion_refresh
+    detect_interval = args.detect_interval
+    tracker_min_confidence = args.tracker_confidence
+    inference_workers = args.workers
+    cascade = args.cascade
+    cascade_band = args.cascade_band
+    max_batch_size = args.max_batch_size
+    max_batch_wait = args.max_batch_wait
+    metrics_port = args.metrics_port
+    photo_format = args.photo_format
+    photo_quality = args.photo_quality
+    photo_queue_size = args.photo_queue_size
+    photo_policy = args.photo_policy
+    reconnect_interval = args.reconnect_interval
+    reconnect_max_interval = args.reconnect_max_interval
+    open_timeout = args.open_timeout
+    read_timeout = args.read_timeout
+    overload_budget = args.overload_budget
@@ -0,0 +1,97 @@
+import os
+import queue
+import threading
+from pathlib import Path
+import cv2
+
+import settings
+
+PHOTO_FORMATS = {
+    "jpg": cv2.IMWRITE_JPEG_QUALITY,
+    "png": cv2.IMWRITE_PNG_COMPRESSION,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+POLICIES = ["drop", "block"]
+
+
+class SnapshotWriter:
+    # encodes and writes the photos on background threads, so a slow disk does not stall the cameras
+    def __init__(self, workers=2, queue_size=32, policy="drop", image_format="jpg", quality=95):
+        self.policy = policy  # "drop" discards a photo when the queue is full, "block" waits for a free place
+        self.image_format = image_format
+        if image_format == "png":
+            # png has no quality, the quality is mapped to a compression level (0-9, 9 is the smallest file)
+            self.params = [PHOTO_FORMATS[image_format], min(9, max(0, (100 - quality) // 10))]
+        else:
+            self.params = [PHOTO_FORMATS[image_format], quality]
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, directory, name, image):
+        # queues the image as directory/name.<format>, returns False when it was dropped
+        item = (directory, name + "." + self.image_format, image)
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put(item, block=self.policy == "block")
+        except queue.Full:
+            with self.lock:
+                self.pending -= 1
+                self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            directory, filename, image = item
+            try:
+                Path(directory).mkdir(parents=True, exist_ok=True)
+                written = cv2.imwrite(os.path.join(directory, filename), image, self.params)
+            except (OSError, cv2.error):
+                written = False
+            with self.lock:
+                self.pending -= 1
+                if written:
+                    self.written += 1
+                else:
+                    self.failed += 1
+            self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        # writes what is still queued before the threads stop
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+snapshot_writer = None
+
+
+def get_snapshot_writer(policy=None):
+    # the policy of the writer is fixed by the first call, settings.photo_policy unless one is given
+    global snapshot_writer
+    if snapshot_writer is None:
+        snapshot_writer = SnapshotWriter(settings.photo_writers, settings.photo_queue_size, policy or settings.photo_policy, settings.photo_format, settings.photo_quality)
+    return snapshot_writer
+
+
+def close_snapshot_writer():
+    global snapshot_writer
+    if snapshot_writer is not None:
+        snapshot_writer.close()
+        snapshot_writer = None
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    # IoU between every (left, top, width, height) box of boxes_a and every box of boxes_b
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(1, -1, 4)
+    inter_w = np.clip(np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    return inter / (a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter + 1e-6)
+
+
+class Track:
+    def __init__(self, track_id, cl, score, box):
+        self.track_id = track_id
+        self.votes = [0, 0]
+        self.score = score
+        self.box = np.asarray(box, dtype=np.float32)
+        self.confidence = 1.0
+        self.vote(cl, score)
+
+    def vote(self, cl, score):
+        # the label of a track is the class the detector gave it most often, so a single wrong detection does not flip it
+        self.votes[cl] += 1
+        self.cl = cl if self.votes[cl] >= self.votes[1 - cl] else 1 - cl
+        self.score = score
+
+
+class BoxTracker:
+    # carries the boxes of the last detection forward with sparse optical flow until the next detection is due
+    def __init__(self, detect_interval=1, min_confidence=0.5, iou_threshold=0.3, grid_size=4):
+        self.detect_interval = detect_interval
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.grid = (np.stack(np.meshgrid(np.arange(grid_size), np.arange(grid_size)), axis=-1).reshape(-1, 2) + 0.5) / grid_size
+        self.tracks = []
+        self.next_id = 0
+        self.prev_gray = None
+        self.frames_since_detection = 0
+        self.confidence = 0.0
+
+    def reset(self):
+        self.tracks = []
+        self.prev_gray = None
+
+    def needs_detection(self):
+        if self.detect_interval <= 1 or self.prev_gray is None:
+            return True
+        return self.frames_since_detection >= self.detect_interval - 1 or self.confidence < self.min_confidence
+
+    def update(self, img, classes, confidences, boxes):
+        # matches a fresh detection to the existing tracks by IoU, so track IDs and their labels carry over
+        tracks = []
+        iou = box_iou(boxes, [track.box for track in self.tracks]) if len(self.tracks) else np.zeros((len(boxes), 0))
+        for i, (cl, score, box) in enumerate(zip(classes, confidences, boxes)):
+            j = int(iou[i].argmax()) if iou.shape[1] else -1
+            if j >= 0 and iou[i, j] >= self.iou_threshold:
+                track = self.tracks[j]
+                iou[:, j] = 0
+                track.box = np.asarray(box, dtype=np.float32)
+                track.vote(int(cl), score)
+            else:
+                track = Track(self.next_id, int(cl), score, box)
+                self.next_id += 1
+            track.confidence = 1.0
+            tracks.append(track)
+        self.tracks = tracks
+        self.prev_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        self.frames_since_detection = 0
+        self.confidence = 1.0
+        return self.detections()
+
+    def track(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.tracks:
+            points = np.concatenate([track.box[:2] + self.grid * track.box[2:] for track in self.tracks]).astype(np.float32)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None)
+            back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, moved, None)
+            # a point is only trusted when tracking it back lands where it started
+            good = (status.ravel() == 1) & (back_status.ravel() == 1) & (np.linalg.norm(back - points, axis=1) < 1.0)
+            for i, track in enumerate(self.tracks):
+                track_points = slice(i * len(self.grid), (i + 1) * len(self.grid))
+                track_good = good[track_points]
+                track.confidence = track_good.mean()
+                if track_good.any():
+                    track.box[:2] += np.median((moved - points)[track_points][track_good], axis=0)
+            self.confidence = min(track.confidence for track in self.tracks)
+        self.prev_gray = gray
+        self.frames_since_detection += 1
+        return self.detections()
+
+    def detections(self):
+        classes = np.array([track.cl for track in self.tracks], dtype=np.int32)
+        confidences = np.array([track.score for track in self.tracks], dtype=np.float32)
+        boxes = np.array([track.box for track in self.tracks], dtype=np.int32).reshape(-1, 4)
+        return classes, confidences, boxes